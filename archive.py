@@ -0,0 +1,191 @@
+# Append-only archive of the payloads the stream handled and what was decided about them.
+# Usage: python3 archive.py ./archive [--tweet ID] [--isin ISIN] [--payloads]
+# --payloads prints the raw payloads as JSONL, which replay.py takes as its tweets file.
+from collections import deque
+from threading import Thread, Event, local
+import json, os, re, struct, time, zlib
+
+_FRAME = struct.Struct('<II') # compressed length, crc32 of the compressed bytes
+_id_re = re.compile(r'"id_str":\s*"(\d+)"')
+
+class Archive:
+    """
+    Each payload handled between begin() and end() on a thread becomes one record, along
+    with anything noted about it meanwhile. Records are only queued on the hot path: a writer
+    thread compresses them in batches into length-prefixed frames, rolling over to a new
+    segment file every segment_size bytes, and indexes every frame by tweet id and ISIN.
+    """
+    def __init__(self, enabled:bool=False):
+        self.enabled = enabled
+        self.dropped = 0
+        self.batch_size = 256; self.max_pending = 100000
+        self._pending = deque()
+        self._local = local()
+        self._wake = Event()
+        self._stop = Event()
+        self._thread = None
+
+    def begin(self, payload:str=None):
+        if not self.enabled: return
+        self._local.record = {'at': time.time(), 'id': peek_id(payload), 'payload': payload}
+
+    def note(self, key:str, value):
+        record = getattr(self._local, 'record', None) if self.enabled else None
+        if record != None: record[key] = value
+
+    def append(self, key:str, value):
+        record = getattr(self._local, 'record', None) if self.enabled else None
+        if record != None: record.setdefault(key, list()).append(value)
+
+    def get(self, key:str):
+        record = getattr(self._local, 'record', None) if self.enabled else None
+        return record.get(key) if record != None else None
+
+    def end(self):
+        record = getattr(self._local, 'record', None) if self.enabled else None
+        if record == None: return
+        self._local.record = None
+        self._queue(record)
+
+    def record(self, record:dict):
+        # a record of its own, e.g. an order placed from another thread than the tweets behind it
+        if self.enabled: self._queue(dict(record, at=time.time()))
+
+    def _queue(self, record:dict):
+        if len(self._pending) >= self.max_pending:
+            self.dropped += 1 # never block the stream on a slow disk
+            return
+        self._pending.append(record)
+        if len(self._pending) >= self.batch_size: self._wake.set()
+
+    def start(self, path:str, segment_size:int=64*1024*1024, batch_size:int=256, flush_interval:float=1, max_pending:int=100000):
+        self.path = path
+        self.segment_size = segment_size; self.batch_size = batch_size
+        self.flush_interval = flush_interval; self.max_pending = max_pending
+        os.makedirs(path, exist_ok=True)
+        segments = sorted(int(name[8:14]) for name in os.listdir(path) if re.match(r'^segment-\d{6}\.t2c$', name))
+        self._segment = segments[-1]+1 if len(segments) > 0 else 1 # a new segment each run, in case the last ended in a torn frame
+        self._file = open(self._segment_path(self._segment), 'ab')
+        self._index = open(os.path.join(path, 'index.jsonl'), 'a')
+        self.enabled = True
+        self._thread = Thread(target=self._loop, daemon=True)
+        self._thread.start()
+
+    def _segment_path(self, segment:int):
+        return os.path.join(self.path, 'segment-{0:06d}.t2c'.format(segment))
+
+    def _loop(self):
+        while not self._stop.is_set():
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try: self.flush()
+            except Exception as e: print('Could not write to the archive: {0!r}'.format(e))
+
+    def flush(self):
+        while len(self._pending) > 0:
+            batch = list()
+            while len(self._pending) > 0 and len(batch) < self.batch_size: batch.append(self._pending.popleft())
+            self._write(batch)
+
+    def _write(self, batch:list):
+        data = zlib.compress('\n'.join(json.dumps(record, default=str) for record in batch).encode())
+        if self._file.tell() > 0 and self._file.tell()+len(data) > self.segment_size:
+            self._file.close()
+            self._segment += 1
+            self._file = open(self._segment_path(self._segment), 'ab')
+
+        offset = self._file.tell()
+        self._file.write(_FRAME.pack(len(data), zlib.crc32(data)) + data)
+        self._file.flush()
+
+        tweets = sorted({tweet for record in batch for tweet in record_tweets(record)})
+        isins = sorted({isin for record in batch for isin in record_isins(record)})
+        self._index.write(json.dumps({'segment': self._segment, 'offset': offset, 'tweets': tweets, 'isins': isins}) + '\n')
+        self._index.flush()
+
+    def stop(self):
+        if self._thread == None: return
+        self._stop.set(); self._wake.set()
+        self._thread.join()
+        self.flush()
+        self._file.close(); self._index.close()
+        self.enabled = False
+        if self.dropped > 0: print('Dropped {0} records the archive couldn\'t keep up with'.format(self.dropped))
+
+def record_tweets(record:dict):
+    # the tweet a record is about, or the tweets behind an order
+    if record.get('id') != None: yield record['id']
+    yield from record.get('order', dict()).get('tweets', ())
+
+def record_isins(record:dict):
+    for match in record.get('matches', ()): yield match[0]
+    if 'order' in record: yield record['order']['isin']
+
+def peek_id(payload):
+    # the tweet's own id_str comes before its user's
+    if payload == None: return None
+    match = _id_re.search(payload)
+    return match.group(1) if match != None else None
+
+class ArchiveReader:
+    """
+    Looks records up through the index, or reads every frame in order
+    """
+    def __init__(self, path:str):
+        self.path = path
+        self.tweets = dict(); self.isins = dict() # -> list of (segment, offset)
+        with open(os.path.join(path, 'index.jsonl')) as file:
+            for line in file:
+                try: frame = json.loads(line)
+                except ValueError: continue # half-written line from a crash
+                where = (frame['segment'], frame['offset'])
+                for tweet in frame['tweets']: self.tweets.setdefault(tweet, list()).append(where)
+                for isin in frame['isins']: self.isins.setdefault(isin, list()).append(where)
+
+    def read_frame(self, segment:int, offset:int):
+        with open(os.path.join(self.path, 'segment-{0:06d}.t2c'.format(segment)), 'rb') as file:
+            file.seek(offset)
+            return self._read(file)
+
+    @staticmethod
+    def _read(file):
+        header = file.read(_FRAME.size)
+        if len(header) < _FRAME.size: return None
+        length, crc = _FRAME.unpack(header)
+        data = file.read(length)
+        if len(data) < length or zlib.crc32(data) != crc: return None # torn write at the end of a segment
+        return [json.loads(line) for line in zlib.decompress(data).decode().split('\n')]
+
+    def by_tweet(self, tweet_id:str):
+        return [record for where in self.tweets.get(str(tweet_id), ()) for record in self.read_frame(*where) or () if str(tweet_id) in record_tweets(record)]
+
+    def by_isin(self, isin:str):
+        return [record for where in self.isins.get(isin, ()) for record in self.read_frame(*where) or () if isin in record_isins(record)]
+
+    def __iter__(self):
+        segments = sorted(name for name in os.listdir(self.path) if re.match(r'^segment-\d{6}\.t2c$', name))
+        for name in segments:
+            with open(os.path.join(self.path, name), 'rb') as file:
+                while True:
+                    records = self._read(file)
+                    if records == None: break
+                    yield from records
+
+archive = Archive()
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Look up archived tweets and trading decisions')
+    parser.add_argument('path', help='archive directory')
+    parser.add_argument('--tweet', help='tweet id to look up')
+    parser.add_argument('--isin', help='ISIN to look up')
+    parser.add_argument('--payloads', action='store_true', help='print only the raw payloads, for replay.py')
+    args = parser.parse_args()
+
+    reader = ArchiveReader(args.path)
+    if args.tweet: records = reader.by_tweet(args.tweet)
+    elif args.isin: records = reader.by_isin(args.isin)
+    else: records = iter(reader)
+    for record in records:
+        if not args.payloads: print(json.dumps(record))
+        elif record.get('payload') != None: print(record['payload'])
@@ -0,0 +1,199 @@
+# Benchmarks for the text-analysis and trading hot paths, against fake_lemon.
+# Usage: python3 bench.py [--only name ...] [--repeat 5] [--save] [--compare]
+# --save writes the results to the baseline file, --compare reports the change against it
+# (and exits with 1 if anything got slower than --tolerance allows).
+# --sample runs the handle_data benchmark on a recorded JSONL stream instead of the synthetic one.
+import sys, io, json, time, random, argparse, platform, contextlib
+
+# everything below must see the fake lemon, including main.py and nlp_analysis.py
+import fake_lemon
+sys.modules['lemon'] = fake_lemon
+
+import main
+from fake_lemon import Lemon, Tradeable
+from twitter import Twitter, CallbackStreamListener
+from nlp_analysis import TextToTradeables
+from catalog import TradeableCatalog
+from scheduler import TradeScheduler
+
+BASELINE_FILE = './bench-baseline.json'
+FOLLOWED = ('25073877', '813286')
+
+COMPANIES = ['Apple', 'Tesla', 'Amazon', 'Microsoft', 'Daimler', 'Volkswagen', 'Siemens', 'Allianz', 'Bayer', 'BASF', 'Adidas', 'Puma',
+             'Lufthansa', 'Deutsche Bank', 'Commerzbank', 'Netflix', 'Facebook', 'Alphabet', 'Nvidia', 'Intel', 'Boeing', 'Disney',
+             'Coca-Cola', 'Pfizer', 'Moderna', 'BioNTech', 'Zoom Video', 'Twitter', 'Nokia', 'Ericsson']
+FILLER = ['the', 'people', 'great', 'country', 'today', 'will', 'never', 'media', 'election', 'vote', 'jobs', 'economy', 'strong',
+          'fake', 'news', 'america', 'world', 'China', 'deal', 'market', 'record', 'terrible', 'wonderful', 'failed', 'win', 'big']
+
+def make_catalog(extra:int=500, seed:int=0):
+    # the real companies plus generated ones, so the index is a realistic size
+    rng = random.Random(seed)
+    tradeables = [{'name': '{0} {1}'.format(name.upper(), rng.choice(['INC.', 'AG', 'SE', 'CORP.'])), 'isin': 'XX{0:010d}'.format(i), 'price': rng.randrange(5, 400)}
+                  for i, name in enumerate(COMPANIES)]
+    syllables = ['ka', 'ro', 'mi', 'tel', 'vex', 'lon', 'dra', 'sun', 'bio', 'tek', 'gar', 'nor']
+    for i in range(extra):
+        name = ''.join(rng.choice(syllables) for _ in range(rng.randrange(2, 4))).upper()
+        tradeables.append({'name': '{0} {1}'.format(name, rng.choice(['HOLDING AG', 'INC.', 'GROUP PLC', 'SE'])), 'isin': 'YY{0:010d}'.format(i), 'price': rng.randrange(1, 300)})
+    Lemon.tradeables = {t['isin']: Tradeable(t['name'], t['isin'], 'stock', t['price']) for t in tradeables}
+    Lemon.prices = dict()
+
+def make_texts(n:int, words:int, density:float, seed:int):
+    # n texts of about `words` words, with `density` of them company names
+    rng = random.Random(seed)
+    texts = list()
+    for _ in range(n):
+        text = [rng.choice(COMPANIES) if rng.random() < density else rng.choice(FILLER) for _ in range(words)]
+        texts.append(' '.join(text).capitalize() + '.')
+    return texts
+
+# fixed corpora of varying length and company density
+CORPORA = {
+    'short-sparse': lambda: make_texts(50, 10, 0.05, 1),
+    'short-dense': lambda: make_texts(50, 10, 0.3, 2),
+    'long-sparse': lambda: make_texts(50, 45, 0.05, 3),
+    'long-dense': lambda: make_texts(50, 45, 0.3, 4),
+}
+
+def make_tweet(text:str, i:int, user:str=FOLLOWED[0], retweet:bool=False):
+    tweet = {'created_at': 'Wed Oct 10 20:19:24 +0000 2020', 'id': i, 'id_str': str(i), 'text': text[:140], 'truncated': len(text) > 140,
+             'user': {'id': int(user), 'id_str': user, 'screen_name': 'user'}, 'entities': {'hashtags': [], 'symbols': [], 'urls': [], 'user_mentions': []},
+             'timestamp_ms': str(1600000000000+i)}
+    if len(text) > 140: tweet['extended_tweet'] = {'full_text': text}
+    if retweet: tweet = dict(tweet, retweeted_status=dict(tweet, id_str=str(i+10**6)), text='RT @user: ' + text[:120] + '...')
+    return tweet
+
+def synthetic_stream(n:int=5000, followed:list=FOLLOWED, seed:int=0):
+    # a stream like the real one: mostly replies from users we don't follow, some deletes and limits
+    rng = random.Random(seed)
+    payloads = list()
+    for i in range(n):
+        kind = rng.random()
+        if kind < 0.1: payloads.append(json.dumps({'delete': {'status': {'id': i, 'id_str': str(i), 'user_id': 1, 'user_id_str': '1'}, 'timestamp_ms': '1600000000000'}}))
+        elif kind < 0.12: payloads.append(json.dumps({'limit': {'track': i, 'timestamp_ms': '1600000000000'}}))
+        else:
+            user = rng.choice(followed) if kind > 0.8 else str(rng.randrange(10**6, 10**9))
+            payloads.append(json.dumps(make_tweet('Tweet number {0} about Apple and Tesla'.format(i), i, user)))
+    return payloads
+
+def time_it(fn, repeat:int=5):
+    # best of repeat, in seconds
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter()-start
+        best = elapsed if best == None else min(best, elapsed)
+    return best
+
+def baseline_handle_data(payloads:list, followed:list):
+    # handle_data before the fast path: decode everything, then check a list
+    handled = 0
+    for data in payloads:
+        try:
+            tweet = json.loads(data)
+            tweet['text']
+        except (KeyError, ValueError): continue
+        try: user = tweet['user']['id_str'].lower()
+        except KeyError: continue
+        if len(followed) <= 0 or user in followed: handled += 1
+    return handled
+
+def fast_handle_data(payloads:list, followed:list):
+    handled = list()
+    listener = CallbackStreamListener(lambda tweet: handled.append(tweet), filter_users=followed, num_threads=1)
+    listener.queue.put = lambda data, priority=None, sent=None: listener.handle_data(data) # handle in line, without the worker threads
+    for data in payloads: listener.on_data(data)
+    listener.close()
+    return len(handled)
+
+def setup_trading():
+    # main.py's globals as __main__ would set them up, but against the fake account
+    main.config = main.load_config(main.KEY_FILE, require_keys=False)
+    main.config.update(verbose=False, **{'order-window': 0})
+    main.policy = main.TradingPolicy(main.config)
+    account = Lemon.select_account('', 'Bench')
+    main.quotes, main.ledger = main.make_position_tracking(account)
+    main.intents = main.make_order_intents(account)
+    main.scheduler = TradeScheduler(lambda entry: main.close_out(account, entry))
+    main.analyses = None # every iteration repeats the same texts
+    return account
+
+# name -> (per-item function, takes the corpus texts and returns the items to time)
+def tweets_of(texts): return [make_tweet(text, i, retweet=i % 3 == 0) for i, text in enumerate(texts)]
+
+BENCHMARKS = {
+    'get_tweet_text': (Twitter.get_tweet_text, tweets_of),
+    'get_noun_phrases': (TextToTradeables.get_noun_phrases, list),
+    'get_sentiment': (TextToTradeables.get_sentiment, list),
+    'process_text-catalog': (lambda text: TextToTradeables.process_text(text, similarity_cutoff=0.8), list),
+    'process_text-http': (lambda text: TextToTradeables.process_text(text, similarity_cutoff=0.8), list),
+    'on_tweet_recieved': (lambda tweet: main.on_tweet_recieved(bench_account, tweet), tweets_of),
+}
+
+def run(names:list, repeat:int=5, sample:list=None):
+    global bench_account
+    make_catalog()
+    bench_account = setup_trading()
+    catalog = TradeableCatalog(loader=Lemon.get_tradeables, refresh_interval=0)
+    catalog.load()
+
+    results = dict()
+    for name in names:
+        if name == 'handle_data':
+            payloads = sample or synthetic_stream()
+            assert baseline_handle_data(payloads, list(FOLLOWED)) == fast_handle_data(payloads, list(FOLLOWED)), 'Fast path handles different tweets!'
+            results['handle_data/baseline-path'] = time_it(lambda: baseline_handle_data(payloads, list(FOLLOWED)), repeat)/len(payloads)
+            results['handle_data/stream'] = time_it(lambda: fast_handle_data(payloads, list(FOLLOWED)), repeat)/len(payloads)
+            continue
+
+        fn, prepare = BENCHMARKS[name]
+        TextToTradeables.catalog = None if name == 'process_text-http' else catalog
+        for corpus, texts in CORPORA.items():
+            items = prepare(texts())
+            # trade() prints every order the fake account turns down, which would be timed along with it
+            with contextlib.redirect_stdout(io.StringIO()):
+                fn(items[0]) # warm up lazily loaded components
+                results['{0}/{1}'.format(name, corpus)] = time_it(lambda: [fn(item) for item in items], repeat)/len(items)
+    TextToTradeables.catalog = None
+    return results
+
+def compare(results:dict, baseline:dict, tolerance:float):
+    regressions = list()
+    for key, seconds in sorted(results.items()):
+        before = baseline.get(key)
+        if before == None:
+            print('{0:45} {1:10.1f}us (new)'.format(key, seconds*1e6))
+            continue
+        change = (seconds-before)/before
+        print('{0:45} {1:10.1f}us {2:+7.1%} (was {3:.1f}us)'.format(key, seconds*1e6, change, before*1e6))
+        if change > tolerance: regressions.append(key)
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the tweet-to-order hot paths')
+    parser.add_argument('--only', nargs='*', default=list(BENCHMARKS.keys()) + ['handle_data'], help='benchmarks to run')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--sample', help='JSONL file of raw stream payloads for handle_data')
+    parser.add_argument('--baseline', default=BASELINE_FILE)
+    parser.add_argument('--save', action='store_true', help='save the results as the new baseline')
+    parser.add_argument('--compare', action='store_true', help='compare the results with the baseline')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='slowdown allowed before --compare fails')
+    args = parser.parse_args()
+
+    sample = None
+    if args.sample:
+        with open(args.sample) as file: sample = [line.rstrip('\n') for line in file if line.strip()]
+    results = run(args.only, args.repeat, sample)
+
+    if args.compare:
+        with open(args.baseline) as file: baseline = json.load(file)['results']
+        regressions = compare(results, baseline, args.tolerance)
+        if len(regressions) > 0:
+            print('Slower than the baseline: {0}'.format(', '.join(regressions)))
+            sys.exit(1)
+    else:
+        for key, seconds in sorted(results.items()): print('{0:45} {1:10.1f}us'.format(key, seconds*1e6))
+
+    if args.save:
+        with open(args.baseline, 'w') as file:
+            json.dump({'python': platform.python_version(), 'machine': platform.machine(), 'time': time.time(), 'results': results}, file, indent=2, sort_keys=True)
@@ -0,0 +1,138 @@
+from collections import OrderedDict
+from threading import RLock, Event
+import hashlib, os, pickle, re, time
+
+class _Flight:
+    # one in-progress load that other threads with the same key wait on
+    def __init__(self):
+        self.done = Event()
+        self.value = None
+        self.error = None
+
+class LookupCache:
+    """
+    Bounded LRU cache with a TTL, negative caching of None results and
+    single-flight loading, so concurrent identical lookups only hit the network once.
+    """
+    def __init__(self, ttl:float=60*60, negative_ttl:float=None, max_size:int=4096):
+        self.ttl = ttl
+        self.negative_ttl = ttl if negative_ttl == None else negative_ttl
+        self.max_size = max_size
+        self.hits = 0; self.misses = 0; self.negative_hits = 0; self.evictions = 0
+        self._entries = OrderedDict() # key -> (value, expires)
+        self._flights = dict()
+        self._lock = RLock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get_or_load(self, key, loader):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry != None and entry[1] > time.time():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                if entry[0] == None: self.negative_hits += 1
+                return entry[0]
+            flight = self._flights.get(key)
+            leader = flight == None
+            if leader:
+                flight = self._flights[key] = _Flight()
+                self.misses += 1
+            else: self.hits += 1
+
+        if not leader:
+            flight.done.wait()
+            if flight.error != None: raise flight.error
+            return flight.value
+
+        try:
+            flight.value = loader()
+            self.put(key, flight.value)
+            return flight.value
+        except Exception as e:
+            flight.error = e # errors are shared with waiters, but never cached
+            raise
+        finally:
+            with self._lock: del self._flights[key]
+            flight.done.set()
+
+    def put(self, key, value):
+        expires = time.time() + (self.ttl if value != None else self.negative_ttl)
+        with self._lock:
+            self._entries[key] = (value, expires)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock: self._entries.clear()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {'size': len(self._entries), 'hits': self.hits, 'misses': self.misses, 'negative-hits': self.negative_hits,
+                'evictions': self.evictions, 'hit-rate': self.hits/total if total > 0 else 0}
+
+    def save(self, path:str):
+        now = time.time()
+        with self._lock: entries = [(k, v) for k, v in self._entries.items() if v[1] > now]
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as file: pickle.dump(entries, file)
+        os.replace(tmp, path)
+
+    def load(self, path:str):
+        if not os.path.exists(path): return 0
+        with open(path, 'rb') as file: entries = pickle.load(file)
+        now = time.time()
+        with self._lock:
+            for key, entry in entries:
+                if entry[1] > now: self._entries[key] = entry
+            while len(self._entries) > self.max_size: self._entries.popitem(last=False)
+        return len(self._entries)
+
+class CacheSet:
+    """
+    The per-source caches, snapshotted together into one file
+    """
+    def __init__(self, **caches):
+        self.caches = caches
+
+    def __getitem__(self, name):
+        return self.caches[name]
+
+    def stats(self):
+        return {name: cache.stats() for name, cache in self.caches.items()}
+
+    def save(self, path:str):
+        for name, cache in self.caches.items(): cache.save('{0}.{1}'.format(path, name))
+
+    def load(self, path:str):
+        return sum(cache.load('{0}.{1}'.format(path, name)) for name, cache in self.caches.items())
+
+class AnalysisCache:
+    """
+    Analyses keyed by a hash of the normalised text. Twitter.get_tweet_text already
+    returns the original text of retweets, so every retweet of a post shares one entry.
+    """
+    def __init__(self, ttl:float=6*60*60, max_size:int=1024):
+        self.cache = LookupCache(ttl=ttl, negative_ttl=ttl, max_size=max_size)
+
+    @staticmethod
+    def key(text:str):
+        text = re.sub(r'https?://\S+', '', str(text).lower()) # the same link is shortened differently every time
+        text = re.sub(r'^rt @\w+:', '', text.strip())
+        return hashlib.sha1(' '.join(text.split()).encode()).hexdigest()
+
+    def analyse(self, text:str, analyse):
+        """
+        Returns (analysis, duplicate), running analyse() only for texts not seen within the TTL
+        """
+        ran = list()
+        def load():
+            ran.append(True)
+            return analyse()
+        return self.cache.get_or_load(AnalysisCache.key(text), load), len(ran) == 0
+
+    def stats(self):
+        return self.cache.stats()
@@ -0,0 +1,206 @@
+from Levenshtein import distance
+from threading import Thread, Event, RLock
+from collections import namedtuple
+from array import array
+import mmap, os, re, struct
+
+def normalise_name(name:str):
+    # lowercase and collapse everything that isn't a letter or digit, so "Apple Inc." == "apple inc"
+    return ' '.join(re.sub(r'[^a-z0-9]+', ' ', str(name).lower()).split())
+
+def ngrams(text:str, n:int=3):
+    text = ' {0} '.format(text)
+    return {text[i:i+n] for i in range(max(len(text)-n+1, 1))}
+
+class TradeableCatalog:
+    """
+    In-memory fuzzy index over every tradeable lemon offers.
+    Names are split into character n-grams so a query only has to be compared
+    (with Levenshtein) against the handful of names sharing most of its n-grams.
+    """
+    def __init__(self, loader=None, refresh_interval:float=6*60*60, n:int=3, min_overlap:float=0.6, max_candidates:int=25, verbose:bool=False, on_load=None):
+        self.loader = loader # callable returning an iterable of tradeables
+        self.on_load = on_load # called with the catalog after every successful load
+        self.verbose = verbose
+        self.refresh_interval = refresh_interval
+        self.n = n; self.min_overlap = min_overlap; self.max_candidates = max_candidates
+        self.complete = False # True once the loader has given us the full list
+        self._lock = RLock()
+        self._stop = Event()
+        self._thread = None
+        self._build(list())
+
+    def _build(self, tradeables):
+        by_isin, names, index = dict(), list(), dict()
+        for tradeable in tradeables: self._insert(tradeable, by_isin, names, index)
+        with self._lock:
+            self._by_isin, self._names, self._index = by_isin, names, index
+
+    def _insert(self, tradeable, by_isin, names, index):
+        if tradeable == None or tradeable.isin in by_isin: return
+        by_isin[tradeable.isin] = tradeable
+        pos = len(names)
+        names.append((normalise_name(tradeable.name), tradeable))
+        for gram in ngrams(names[pos][0], self.n):
+            index.setdefault(gram, list()).append(pos)
+
+    def __len__(self):
+        return len(self._names)
+
+    def add(self, tradeable):
+        # lets the HTTP fallback teach the catalog about tradeables it missed
+        with self._lock: self._insert(tradeable, self._by_isin, self._names, self._index)
+
+    def get(self, isin:str):
+        return self._by_isin.get(isin)
+
+    def load(self):
+        if not callable(self.loader): return False
+        tradeables = list(self.loader())
+        if len(tradeables) <= 0: return False
+        self._build(tradeables)
+        self.complete = True
+        if self.on_load != None: self.on_load(self)
+        return True
+
+    def start(self, wait:bool=True):
+        """
+        Load (in the background unless wait), then refresh in the background
+        """
+        if wait: self._load_logged()
+        if self._thread == None:
+            self._thread = Thread(target=self._refresh_loop, args=(not wait, ), daemon=True)
+            self._thread.start()
+
+    def _load_logged(self):
+        try:
+            if self.load() and self.verbose: print('Loaded {0} tradeables into the catalog'.format(len(self)))
+        except Exception as e: print('Could not load tradeable catalog: {0}'.format(e))
+
+    def stop(self):
+        self._stop.set()
+
+    def _refresh_loop(self, load_now:bool=False):
+        if load_now: self._load_logged()
+        if self.refresh_interval <= 0: return
+        while not self._stop.wait(self.refresh_interval): self._load_logged()
+
+    def search(self, query:str, search_for:str=None):
+        """
+        Returns the best matching tradeable and its similarity (distance/len(query)), or (None, None)
+        """
+        with self._lock: names, index = self._names, self._index
+        return rank(query, lambda gram: index.get(gram, ()), lambda pos: names[pos][1], self.n, self.min_overlap, self.max_candidates, search_for)
+
+def rank(query:str, postings, record, n:int=3, min_overlap:float=0.6, max_candidates:int=25, search_for:str=None):
+    # postings(gram) gives the positions of names containing gram, record(pos) the tradeable at pos
+    norm = normalise_name(query)
+    if len(norm) <= 0: return None, None
+
+    grams = ngrams(norm, n)
+    hits = dict()
+    for gram in grams:
+        for pos in postings(gram): hits[pos] = hits.get(pos, 0) + 1
+
+    needed = min_overlap * len(grams)
+    candidates = sorted((pos for pos, count in hits.items() if count >= needed), key=lambda pos: -hits[pos])
+    best, best_dist = None, None
+    for pos in candidates[:max_candidates]:
+        tradeable = record(pos)
+        if search_for and str(getattr(tradeable, 'type', search_for)).lower() != search_for: continue
+        dist = distance(str(tradeable.name).lower(), query.lower())
+        if best_dist == None or dist < best_dist: best, best_dist = tradeable, dist
+
+    if best == None: return None, None
+    return best, best_dist/len(query)
+
+def suffix_search(search, query:str, search_for:str=None):
+    # search(query), dropping leading words until something matches
+    tradeable, similarity = search(query, search_for=search_for)
+    while tradeable == None and ' ' in query and len(query) > 1:
+        query = query[query.find(' ')+1:]
+        tradeable, similarity = search(query, search_for=search_for)
+    return tradeable, similarity
+
+# A read-only copy of a catalog's index in one file, memory-mapped by every worker process
+# so they share the same pages instead of each building their own copy. Layout (little endian):
+#   header: magic, n (gram size), record count, gram count
+#   records: (offset, length) of each "name\x1fisin\x1ftype" string in the blob
+#   grams: sorted (gram padded to 4 bytes, first posting, posting count)
+#   postings: record positions, uint32
+#   blob: utf-8 strings
+IndexedTradeable = namedtuple('IndexedTradeable', ('name', 'isin', 'type'))
+_MAGIC = b'T2CIDX01'
+_HEADER = struct.Struct('<8sIII')
+_RECORD = struct.Struct('<II')
+_GRAM = struct.Struct('<4sII')
+
+def write_index(catalog:TradeableCatalog, path:str):
+    with catalog._lock: names, index = list(catalog._names), {gram: list(postings) for gram, postings in catalog._index.items()}
+
+    blob, records = bytearray(), list()
+    for _, tradeable in names:
+        data = '\x1f'.join((str(tradeable.name), str(tradeable.isin), str(getattr(tradeable, 'type', '')))).encode()
+        records.append((len(blob), len(data)))
+        blob += data
+
+    grams, postings = list(), list()
+    for gram in sorted(index.keys()):
+        grams.append((gram.encode().ljust(4, b'\0'), len(postings), len(index[gram])))
+        postings.extend(index[gram])
+
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as file:
+        file.write(_HEADER.pack(_MAGIC, catalog.n, len(records), len(grams)))
+        for record in records: file.write(_RECORD.pack(*record))
+        for gram in grams: file.write(_GRAM.pack(*gram))
+        file.write(array('I', postings).tobytes())
+        file.write(blob)
+    os.replace(tmp, path) # workers holding the old file keep their mapping until they reopen
+
+class MappedIndex:
+    """
+    Searches an index written by write_index without loading it into memory
+    """
+    def __init__(self, path:str, min_overlap:float=0.6, max_candidates:int=25):
+        self.path = path
+        self.min_overlap = min_overlap; self.max_candidates = max_candidates
+        self.open()
+
+    def open(self):
+        with open(self.path, 'rb') as file:
+            self.mtime = os.fstat(file.fileno()).st_mtime
+            self._map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.n, self.records, self.grams = _HEADER.unpack_from(self._map, 0)
+        assert magic == _MAGIC, 'Not a tradeable index: {0}'.format(self.path)
+        self._grams_at = _HEADER.size + self.records*_RECORD.size
+        self._postings_at = self._grams_at + self.grams*_GRAM.size
+        postings = _GRAM.unpack_from(self._map, self._grams_at + (self.grams-1)*_GRAM.size) if self.grams > 0 else (None, 0, 0)
+        self._blob_at = self._postings_at + (postings[1]+postings[2])*4
+        self._postings = memoryview(self._map)[self._postings_at:self._blob_at].cast('I')
+
+    def reopen_if_changed(self):
+        if os.stat(self.path).st_mtime != self.mtime: self.open()
+
+    def __len__(self):
+        return self.records
+
+    def postings(self, gram:str):
+        # binary search of the sorted gram table
+        key = gram.encode().ljust(4, b'\0')
+        lo, hi = 0, self.grams
+        while lo < hi:
+            mid = (lo+hi)//2
+            found, first, count = _GRAM.unpack_from(self._map, self._grams_at + mid*_GRAM.size)
+            if found == key: return self._postings[first:first+count]
+            if found < key: lo = mid+1
+            else: hi = mid
+        return ()
+
+    def record(self, pos:int):
+        offset, length = _RECORD.unpack_from(self._map, _HEADER.size + pos*_RECORD.size)
+        start = self._blob_at + offset
+        return IndexedTradeable(*self._map[start:start+length].decode().split('\x1f'))
+
+    def search(self, query:str, search_for:str=None):
+        return rank(query, self.postings, self.record, self.n, self.min_overlap, self.max_candidates, search_for)
@@ -0,0 +1,92 @@
+# In-process stand-in for lemon.py with a static catalog and price table.
+# Used by replay.py so tweets can be replayed without a real account.
+from datetime import datetime, timedelta
+from threading import RLock
+import json, time
+
+class Tradeable:
+    def __init__(self, name:str, isin:str, type:str='stock', price:float=1.0):
+        self.name = name; self.isin = isin; self.type = type; self.price = price
+    def get_cost(self):
+        return Lemon.prices.get(self.isin, self.price)
+    def __repr__(self):
+        return 'Tradeable({0}, {1})'.format(self.name, self.isin)
+
+class Lemon:
+    tradeables = dict() # isin -> Tradeable
+    prices = dict() # isin -> price, overrides the tradeable's own
+    open_for = 8*60*60 # seconds until the market closes
+    opens_in = 0 # seconds until the market opens
+    search_latency = 0 # seconds each search pretends to take
+
+    @staticmethod
+    def load(path:str):
+        with open(path) as file: data = json.load(file)
+        Lemon.tradeables = {t['isin']: Tradeable(t['name'], t['isin'], t.get('type', 'stock'), t.get('price', 1.0)) for t in data['tradeables']}
+        Lemon.prices = dict(data.get('prices', dict()))
+        return len(Lemon.tradeables)
+
+    @staticmethod
+    def get_tradeables(search_for:str='stock'):
+        return [t for t in Lemon.tradeables.values() if t.type == search_for]
+
+    @staticmethod
+    def search_for_tradeable(query:str, search_type:str='name', search_for:str='stock'):
+        if Lemon.search_latency > 0: time.sleep(Lemon.search_latency)
+        query = str(query).lower()
+        for tradeable in Lemon.tradeables.values():
+            if search_for and tradeable.type != search_for: continue
+            if search_type == 'isin' and tradeable.isin.lower() == query: return tradeable
+            if search_type == 'name' and query in tradeable.name.lower(): return tradeable
+        return None
+
+    @staticmethod
+    def next_market_closing():
+        return datetime.now().astimezone() + timedelta(seconds=Lemon.open_for)
+
+    @staticmethod
+    def next_market_availability():
+        return datetime.now().astimezone() + timedelta(seconds=Lemon.opens_in)
+
+    @staticmethod
+    def select_account(token:str, name:str):
+        return Account(name)
+
+class Account:
+    def __init__(self, name:str='Replay', funds:float=10000):
+        self.name = name; self.funds = funds
+        self.holdings = dict() # isin -> quantity
+        self.orders = list()
+        self._lock = RLock()
+
+    def _order(self, side:str, tradeable, quantity:int):
+        with self._lock:
+            if quantity <= 0: raise ValueError('Quantity must be positive')
+            price = tradeable.get_cost()
+            held = self.holdings.get(tradeable.isin, 0)
+            if side == 'sell': quantity = min(quantity, held)
+            self.holdings[tradeable.isin] = held + (quantity if side == 'buy' else -quantity)
+            self.funds += price*quantity*(-1 if side == 'buy' else 1)
+            self.orders.append({'time': time.time(), 'side': side, 'isin': tradeable.isin, 'name': tradeable.name, 'quantity': quantity, 'price': price})
+
+    def create_buy_order(self, tradeable, quantity:int=1, handle_errors:bool=False):
+        self._order('buy', tradeable, quantity)
+
+    def create_sell_order(self, tradeable, quantity:int=1, handle_errors:bool=False):
+        try: self._order('sell', tradeable, quantity)
+        except ValueError:
+            if not handle_errors: raise
+
+    def get_orders(self):
+        return list()
+
+    def get_funds(self):
+        return self.funds
+
+class HeldTradeable(Tradeable):
+    def __init__(self, isin:str, account:Account):
+        tradeable = Lemon.tradeables.get(isin)
+        super().__init__(tradeable.name if tradeable else isin, isin)
+        self.account = account
+    def get_amount(self):
+        return self.account.holdings.get(self.isin, 0)
@@ -0,0 +1,84 @@
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread
+from requests.exceptions import HTTPError
+from Levenshtein import distance
+from nlp_analysis import TextToTradeables
+from metrics import metrics
+import asyncio
+
+class LookupEngine:
+    """
+    Resolves every noun phrase and cashtag of a tweet at once on an event loop,
+    with at most `concurrency` HTTP lookups in flight.
+    The blocking lemon and Yahoo clients run on a bounded thread pool.
+    """
+    def __init__(self, symbol_to_name, concurrency:int=8):
+        self.symbol_to_name = symbol_to_name # e.g. Twitter.cashtag_to_stock
+        self.executor = ThreadPoolExecutor(concurrency)
+        self.loop = asyncio.new_event_loop()
+        self._thread = Thread(target=self.loop.run_forever, daemon=True)
+        self._thread.start()
+
+    def _call(self, fn, *args, **kwargs):
+        return self.loop.run_in_executor(self.executor, lambda: fn(*args, **kwargs))
+
+    async def deep_search(self, query:str, search_for:str='stock', similarity_cutoff:float=None):
+        """
+        Same answer as TextToTradeables.deep_search. Phrases are searched concurrently with each other,
+        but a phrase's suffixes one after another, so a phrase that matches whole costs one call.
+        """
+        if query == None or len(query) <= 0: return None, None
+        catalog = TextToTradeables.catalog
+        if catalog != None and len(catalog) > 0:
+            result = TextToTradeables.catalog_search(catalog, query, search_for=search_for)
+            if catalog.complete or TextToTradeables.catalog_hit(result, similarity_cutoff): return result
+
+        suffix = query
+        while True:
+            metrics.count('http-search')
+            try: tradeable = await self._call(TextToTradeables.search_for_tradeable, suffix, search_type='name', search_for=search_for)
+            except HTTPError: return None, None
+            if tradeable != None:
+                if catalog != None: catalog.add(tradeable)
+                return tradeable, distance(tradeable.name.lower(), suffix.lower())/len(suffix)
+            if ' ' not in suffix or len(suffix) <= 1: return None, None
+            suffix = suffix[suffix.find(' ')+1:]
+
+    async def cashtag(self, symbol:str):
+        name = await self._call(self.symbol_to_name, symbol)
+        if name == None: return None
+        try: return await self._call(TextToTradeables.search_for_tradeable, name)
+        except HTTPError: return None
+
+    async def _cashtags(self, symbols:list):
+        return await asyncio.gather(*[self.cashtag(s) for s in symbols])
+
+    def cashtags(self, symbols:list):
+        """
+        Returns the tradeables the symbols stand for, looked up all at once
+        """
+        return [t for t in asyncio.run_coroutine_threadsafe(self._cashtags(symbols), self.loop).result() if t != None]
+
+    async def lookup(self, entities:list, symbols:list, search_for:str='stock', similarity_cutoff:float=None):
+        return await asyncio.gather(*[self.deep_search(e, search_for=search_for, similarity_cutoff=similarity_cutoff) for e in entities], *[self.cashtag(s) for s in symbols])
+
+    def resolve(self, text:str, symbols:list, search_for:str='stock', similarity_cutoff:float=1.4, min_noun_length:int=4):
+        """
+        Returns ([(tradeable, similarity)] for the text's noun phrases, [tradeable] for its cashtags)
+        """
+        # chunking is CPU work, so it stays on the calling thread rather than the event loop
+        with metrics.stage('noun-phrases'): entities = TextToTradeables.get_noun_phrases(str(text))
+        entities = [str(e) for e in entities if min_noun_length <= 0 or len(str(e).replace(' ','')) >= min_noun_length]
+
+        with metrics.stage('search'):
+            results = asyncio.run_coroutine_threadsafe(self.lookup(entities, symbols, search_for=search_for, similarity_cutoff=similarity_cutoff), self.loop).result()
+        companies = [ds for ds in results[:len(entities)] if ds[0] != None and ds[1] < similarity_cutoff]
+        return companies, [t for t in results[len(entities):] if t != None]
+
+    def process_text(self, text, search_for:str='stock', similarity_cutoff:float=1.4, min_noun_length:int=4):
+        return self.resolve(text, list(), search_for=search_for, similarity_cutoff=similarity_cutoff, min_noun_length=min_noun_length)[0]
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self.executor.shutdown(wait=False, cancel_futures=True)
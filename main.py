@@ -1,13 +1,31 @@
-# Try to download and import lemon.
-import dl_lemon
+import time
+started = time.perf_counter()
+
+# Import lemon, only trying to download it if it's missing.
 try: from lemon import Lemon, Account, HeldTradeable
-except ImportError: raise Exception('Could not find or download lemon.py! Please download it from https://github.com/Pop101/Lemon/blob/master/lemon.py manually.')
+except ImportError:
+    import dl_lemon
+    try: from lemon import Lemon, Account, HeldTradeable
+    except ImportError: raise Exception('Could not find or download lemon.py! Please download it from https://github.com/Pop101/Lemon/blob/master/lemon.py manually.')
 
 # Regular Imports
 from twitter import Twitter
-from nlp_analysis import TextToTradeables, StoppableTimer
+import nlp_analysis
+from nlp_analysis import TextToTradeables, NounPhrasePipeline
+from catalog import TradeableCatalog, write_index
+from cache import LookupCache, CacheSet, AnalysisCache
+from metrics import metrics
+from archive import archive
+from scheduler import TradeScheduler
+from orders import OrderIntents
+from lookup import LookupEngine
+from market_calendar import MarketCalendar
+from quotes import QuoteCache, PositionLedger
+from policy import TradingPolicy, ConfigWatcher
+from shutdown import ShutdownCoordinator
+from workers import AnalysisWorkers
 from datetime import datetime
-from requests.exceptions import HTTPError
+from threading import Thread
 import os
 
 import yaml
@@ -18,7 +36,7 @@ except ImportError: from yaml import Loader
 KEY_FILE = './config.yml'
 
 # Load all the keys and config options we need
-def load_config(path='./config.yml'):
+def load_config(path='./config.yml', require_keys:bool=True):
     assert os.path.exists(path), "Config does not exist!"
     with open(path) as file:
         yml = yaml.load(file.read(), Loader=Loader)
@@ -35,153 +53,420 @@ def load_config(path='./config.yml'):
             config['weighted'] = yml['weighted-factor']
             config['users'] = [str(usr) for usr in yml['user-ids']]
             config['denylist'] = [str(usr).lower().strip() for usr in yml['denylist']]
+            config['limits'] = yml.get('transaction-limits') or dict()
+            config['reload'] = yml.get('config-reload', dict())
+            config['shutdown'] = yml.get('shutdown', dict())
+            config['archive'] = yml.get('archive', dict())
+            config['catalog-refresh'] = yml.get('catalog-refresh', 6*60*60)
+            config['cache'] = yml.get('cache', dict())
+            config['nlp-processes'] = yml.get('nlp-processes', 0)
+            config['metrics'] = yml.get('metrics', dict())
+            config['journal'] = yml.get('trade-journal')
+            config['order-window'] = yml.get('order-window', 2)
+            config['lookup-concurrency'] = yml.get('lookup-concurrency', 8)
+            config['market-hours'] = yml.get('market-hours')
+            config['quote-age'] = yml.get('quote-max-age', 30)
+            config['reconcile'] = yml.get('reconcile-interval', 5*60)
+            config['startup'] = yml.get('startup', dict())
+            config['workers'] = yml.get('workers', dict())
+            config['analysis-cache'] = yml.get('analysis-cache', dict())
+            config['trade-duplicates'] = config['analysis-cache'].get('trade-duplicates', False)
+            ingest = yml.get('ingest', dict())
+            config['ingest'] = {'num_threads': ingest.get('threads', 5), 'max_queue': ingest.get('max-queue', 256), 'overflow': ingest.get('overflow', 'drop-oldest'),
+                                'max_age': ingest.get('max-age'), 'priorities': ingest.get('priorities', dict())}
         except KeyError: 
             print('Error in config')
             quit(1)
         del yml
-    assert '<KEY>' not in repr(config), 'Please add your keys to the config!'
+    assert not require_keys or '<KEY>' not in repr(config), 'Please add your keys to the config!'
     return config
 
-def on_tweet_recieved(account:Account, tweet):
-    txt = Twitter.get_tweet_text(tweet)
-
+def analyse_tweet(tweet, txt:str):
+    """
+    Returns the tweet's sentiment and the (tradeable, similarity) pairs it mentions
+    """
     # get tweet sentiment
-    sent = TextToTradeables.get_sentiment(txt)
+    with metrics.stage('sentiment'): sent = TextToTradeables.get_sentiment(txt)
 
-    # search body with nlp
-    stocks = TextToTradeables.process_text(txt, similarity_cutoff=config['match'], min_noun_length=4)
-    # re-prune the stock list
-    stocks = list(filter(lambda stock: stock[1]*len(stock[0].name) <= config['weighted'], stocks))
+    # search body with nlp and twitter cashtags ($STOCK), all at once if we have a lookup engine
+    symbols = Twitter.get_tweet_cashtags(tweet)
+    if TextToTradeables.lookups != None:
+        stocks, cashtags = TextToTradeables.lookups.resolve(txt, symbols, similarity_cutoff=policy.match, min_noun_length=4)
+        cashtags = [(tradeable, 0) for tradeable in cashtags]
+    else:
+        stocks = TextToTradeables.process_text(txt, similarity_cutoff=policy.match, min_noun_length=4)
+        cashtags = [(tradeable, 0) for tradeable in resolve_cashtags(symbols)]
 
-    # search twitter cashtags ($STOCK)
-    cashtags = [(Lemon.search_for_tradeable(Twitter.cashtag_to_stock(q)), 0) for q in Twitter.get_tweet_cashtags(tweet)]
-    cashtags = list(filter(lambda x: x != None and x[0] != None, cashtags))
+    # pruning by weighted-factor happens in trade(), with the policy of the moment
     stocks.extend(cashtags)
 
     if config['verbose'] and len(cashtags) > 0:
-        print('Cashtag IO: i:{0}, o:{1}'.format(Twitter.get_tweet_cashtags(tweet), [q[0].name for q in cashtags]))
-    
+        print('Cashtag IO: i:{0}, o:{1}'.format(symbols, [q[0].name for q in cashtags]))
+    return sent, stocks
+
+def resolve_cashtags(symbols:list):
+    # the company name from Yahoo, then lemon's search for it
+    if TextToTradeables.lookups != None: return TextToTradeables.lookups.cashtags(symbols)
+    with metrics.stage('cashtags'):
+        tradeables = [TextToTradeables.search_for_tradeable(name) for name in map(Twitter.cashtag_to_stock, symbols) if name != None]
+    return [tradeable for tradeable in tradeables if tradeable != None]
+
+# analyses of recently seen texts, so retweets and duplicates aren't analysed twice
+analyses = None
+
+# the compiled trading options, replaced as a whole when config.yml changes
+policy = None
+
+def on_tweet_recieved(account:Account, tweet):
+    with metrics.stage('text'): txt = Twitter.get_tweet_text(tweet)
+
+    duplicate = False
+    if analyses != None: (sent, stocks), duplicate = analyses.analyse(txt, lambda: analyse_tweet(tweet, txt))
+    else: sent, stocks = analyse_tweet(tweet, txt)
+    if archive.enabled: archive_analysis(txt, sent, stocks, duplicate=duplicate)
+
+    if duplicate:
+        metrics.count('duplicate-tweets')
+        if not config['trade-duplicates']:
+            if config['verbose'] and len(stocks) > 0 and sent != 0: print('Not trading again on "{0}"'.format(txt))
+            return
+    trade(account, txt, sent, stocks)
+
+def on_analysis_recieved(account:Account, txt:str, sent:float, found:list, symbols:list, tweet_id:str=None):
+    # an analysis from a worker process, with ISINs in place of tradeables. Cashtags
+    # are left to this process, so they're resolved the same way as without workers
+    archive.begin()
+    try:
+        analyse = lambda: ([(find_tradeable(isin, account), similarity) for isin, similarity in found] + [(t, 0) for t in resolve_cashtags(symbols)])
+        duplicate = False
+        if analyses != None: stocks, duplicate = analyses.analyse(txt, analyse)
+        else: stocks = analyse()
+        if archive.enabled: archive_analysis(txt, sent, stocks, duplicate=duplicate, tweet_id=tweet_id)
+
+        if duplicate:
+            metrics.count('duplicate-tweets')
+            if not config['trade-duplicates']:
+                if config['verbose'] and len(stocks) > 0 and sent != 0: print('Not trading again on "{0}"'.format(txt))
+                return
+        trade(account, txt, sent, stocks)
+    finally: archive.end()
+
+def archive_analysis(txt:str, sent:float, stocks:list, duplicate:bool=False, tweet_id:str=None):
+    if tweet_id != None: archive.note('id', tweet_id)
+    archive.note('text', txt)
+    archive.note('sentiment', sent)
+    archive.note('matches', [(stock[0].isin, str(stock[0].name), stock[1]) for stock in stocks])
+    if duplicate: archive.note('duplicate', True)
+
+def trade(account:Account, txt:str, sent:float, stocks:list):
     if len(stocks) <= 0 or sent == 0: return
 
+    # remove like stocks, listed stocks and weak matches
+    stocks = policy.select(stocks)
+    archive.note('selected', [stock[0].isin for stock in stocks])
+    if len(stocks) <= 0: return
+
     if config['verbose']:
         to_print = '"{0}":\n'.format(txt)
         to_print += '\t{0} these stocks with a sentiment of {1}:\n'.format('Buying' if sent > 0 else 'Selling', sent)
         for stock in stocks:
-            to_print += '\t\t{0} at ${1} (sim: {2}, w_sim: {3})\n'.format(stock[0].name, stock[0].get_cost(), stock[1], stock[1]*len(stock[0].name))
+            to_print += '\t\t{0} at ${1} (sim: {2}, w_sim: {3})\n'.format(stock[0].name, get_cost(stock[0]), stock[1], stock[1]*len(stock[0].name))
         print(to_print)
-    
-    # remove like stocks and listed stocks
-    found_tradeables, unique_stocks = list(), list()
-    for stock in stocks: 
-        if stock[0].isin not in found_tradeables and str(stock[0].name).lower().strip() not in config['denylist']:
-            found_tradeables.append(stock[0].isin)
-            unique_stocks.append(stock)
-    stocks = unique_stocks
-    del found_tradeables, unique_stocks
 
     # trade the stocks based on sentiment
     for stock in stocks:
         if sent > 0: result, code = bull(account, stock[0])
         if sent < 0: result, code = bear(account, stock[0])
         
-        if not result: print('Error handling stock {0}: "{1}"'.format(stock[0].name, code))
+        if not result:
+            archive.append('rejected', (stock[0].isin, code))
+            print('Error handling stock {0}: "{1}"'.format(stock[0].name, code))
         elif config['verbose']: print('{0} on {1}'.format(code,stock[0].name))
 
-# we must keep a list of scheduled trades in case of program stop 
-scheduled_trades = list()
+def make_caches(options:dict):
+    # each source gets its own TTLs, since "no match" answers rarely change but prices and listings do
+    def make(name, ttl, negative_ttl):
+        opts = options.get(name, dict())
+        return LookupCache(ttl=opts.get('ttl', ttl), negative_ttl=opts.get('negative-ttl', negative_ttl), max_size=opts.get('max-size', 4096))
+    return CacheSet(lemon=make('lemon', 6*60*60, 24*60*60), yahoo=make('yahoo', 24*60*60, 24*60*60))
+
+def load_tradeables():
+    # not every version of lemon.py can list all instruments. Without it the catalog
+    # only learns from HTTP searches, which stay as the fallback
+    lister = getattr(Lemon, 'get_tradeables', None)
+    return lister(search_for='stock') if callable(lister) else list()
+
+# scheduled close-outs, journaled in case of program stop
+scheduler = None
+# every order goes through here to be merged and netted per ISIN
+intents = None
+# recent prices and what we hold, so the order path only calls lemon for the order itself
+quotes, ledger = None, None
+
+def get_cost(tradeable):
+    return quotes.cost(tradeable) if quotes != None else tradeable.get_cost()
+
+def get_held(isin:str, account:Account):
+    return ledger.get(isin) if ledger != None else HeldTradeable(isin, account).get_amount()
+
+def make_position_tracking(account:Account):
+    ledger = PositionLedger(lambda isin: HeldTradeable(isin, account).get_amount(), reconcile_interval=config['reconcile'], verbose=config['verbose'])
+    return QuoteCache(max_age=config['quote-age']), ledger
+
+def submit_order(account:Account, tradeable, side:str, quantity:int):
+    if side == 'buy': account.create_buy_order(tradeable, quantity=quantity)
+    else: account.create_sell_order(tradeable, quantity=quantity)
+    if ledger != None: ledger.record(tradeable.isin, side, quantity)
+
+def make_order_intents(account:Account):
+    return OrderIntents(lambda tradeable, side, quantity: submit_order(account, tradeable, side, quantity),
+        lambda isin: get_held(isin, account), window=config['order-window'], limit=lambda isin: policy.limit_for(isin), cost=get_cost,
+        close_out=schedule_close_out, verbose=config['verbose'])
+
+def schedule_close_out(tradeable, side:str, quantity:int, when:float, sell_all:bool):
+    # called once the order being closed was submitted, with the quantity it really traded
+    origin = {'side': 'sell' if side == 'buy' else 'buy', 'quantity': quantity, 'submitted': time.time()}
+    scheduler.schedule(when-time.time(), side, tradeable, quantity, sell_all=sell_all, origin=origin)
+
+def find_tradeable(isin:str, account:Account):
+    catalog = TextToTradeables.catalog
+    tradeable = catalog.get(isin) if catalog != None else None
+    return tradeable if tradeable != None else HeldTradeable(isin, account)
+
+def close_out(account:Account, entry:dict):
+    """
+    Execute a trade the scheduler deferred until close, or put it off until the market
+    opens if it's closed (e.g. overdue ones from the journal after a restart at night)
+    """
+    with metrics.stage('market-hours'): _, time_to_open = market_times()
+    if time_to_open > 60: # lemon's answer is a little in the future even while open
+        if config['verbose']: print('Market closed, putting off the {0} of {1} for {2:.0f}s'.format(entry['side'], entry['name'], time_to_open))
+        return time_to_open
+    tradeable = scheduler.tradeables.get(entry['id']) or find_tradeable(entry['isin'], account)
+    intents.add(tradeable, entry['side'], entry['quantity'], sell_all=entry['all'])
+
+def close_out_now(account:Account, entry:dict):
+    # on shutdown: no netting window, and errors are raised so the trade can be retried
+    tradeable = scheduler.tradeables.get(entry['id']) or find_tradeable(entry['isin'], account)
+    quantity = entry['quantity']
+    if entry['side'] == 'sell':
+        held = get_held(entry['isin'], account)
+        quantity = held if entry['all'] else min(quantity, held)
+    else:
+        try: quantity = min(quantity, int(policy.limit_for(entry['isin'])/get_cost(tradeable))) # as net() caps them
+        except ZeroDivisionError: pass
+    if quantity <= 0: return
+    order = {'isin': entry['isin'], 'name': entry['name'], 'side': entry['side'], 'quantity': quantity, 'close-out': entry['id']}
+    try: submit_order(account, tradeable, entry['side'], quantity)
+    except Exception as e:
+        archive.record({'order': dict(order, ok=False, error=repr(e))})
+        raise
+    archive.record({'order': dict(order, ok=True)})
+
+def position_value(account:Account, entry:dict):
+    tradeable = scheduler.tradeables.get(entry['id']) or find_tradeable(entry['isin'], account)
+    quantity = get_held(entry['isin'], account) if entry['all'] else entry['quantity']
+    return quantity*get_cost(tradeable)
+
+def make_shutdown(account:Account):
+    options = config['shutdown']
+    return ShutdownCoordinator(scheduler, account.get_orders, lambda entry: close_out_now(account, entry), value=lambda entry: position_value(account, entry),
+        intents=intents, ledger=ledger, holdings=lambda isin: HeldTradeable(isin, account).get_amount(), concurrency=options.get('concurrency', 8),
+        deadline=options.get('deadline', 20), retries=options.get('retries', 2), verbose=config['verbose'])
+
+# session boundaries worked out locally, instead of asking lemon for every stock
+calendar = None
+
+def market_times():
+    """
+    Seconds until the market closes and until it opens (negative while open)
+    """
+    now = datetime.now().astimezone()
+    if calendar != None: return (calendar.next_closing(now)-now).total_seconds(), (calendar.next_availability(now)-now).total_seconds()
+    return (Lemon.next_market_closing()-now).total_seconds(), (Lemon.next_market_availability()-now).total_seconds()
 
 def bull(account:Account, tradeable):
     """
     Buy now, sell at close
     """
-    try: quantity = int(config['limit']/tradeable.get_cost())
+    current = policy # the same policy for the whole trade, even if it's swapped meanwhile
+    try: quantity = int(current.limit_for(tradeable.isin)/get_cost(tradeable))
     except ZeroDivisionError: quantity = 1
     if quantity <= 0: return (False, 'Price higher than set limit') # can't trade fractions kid
 
-    time_to_close = (Lemon.next_market_closing()-datetime.now().astimezone()).total_seconds()
-    if time_to_close < config['limit-time']: return (False, 'Too close to closing time!'  if time_to_close > 0 else 'Market Closed') # don't go for profit 1 hr before close
+    with metrics.stage('market-hours'): time_to_close, time_to_open = market_times()
+    if time_to_close < current.limit_time: return (False, 'Too close to closing time!'  if time_to_close > 0 else 'Market Closed') # don't go for profit 1 hr before close
 
-    time_to_open = (Lemon.next_market_availability()-datetime.now().astimezone()).total_seconds()
-    if time_to_open > config['limit-time']: return (False, 'Too far from opening time.') # don't try more than 1 hour before market start
+    if time_to_open > current.limit_time: return (False, 'Too far from opening time.') # don't try more than 1 hour before market start
 
-    # buy
-    try: account.create_buy_order(tradeable, quantity=quantity)
-    except HTTPError as e: return (False, 'HTTPError when creating buy order for {0}: {1} {2}'.format(tradeable.name, e.errno, e.strerror))
-    
-    def sell_later():
-        if config['nuke']: quantity = int(HeldTradeable(tradeable.isin, account).get_amount())
-        try: account.create_sell_order(tradeable, quantity=quantity, handle_errors=True)
-        except HTTPError as e: 
-            if config['verbose']: print('HTTPError when creating sell order for {0} after buying: {1} {2}'.format(tradeable.name, e.errno, e.strerror))
-    
-    timer = StoppableTimer(time_to_close-config['limit-time'], sell_later)
-    scheduled_trades.append(timer)
+    # buy, selling what was bought at close once the (netted) order is placed
+    intents.add(tradeable, 'buy', quantity, close_out=(time.time()+time_to_close-current.limit_time, current.sell_all), source=archive.get('id'))
+    archive.append('intents', {'isin': tradeable.isin, 'side': 'buy', 'quantity': quantity}) # the orders really placed are archived by OrderIntents
     return (True, 'Executing bullish strategy with a quantity of {0}'.format(quantity))
 
 def bear(account:Account, tradeable):
     """
     Sell now (if any are held), buy at close
     """
-    try: quantity = int(config['limit']/tradeable.get_cost())
+    current = policy # the same policy for the whole trade, even if it's swapped meanwhile
+    try: quantity = int(current.limit_for(tradeable.isin)/get_cost(tradeable))
     except ZeroDivisionError: quantity = 1
     if quantity <= 0: return (False, 'Price higher than set limit') # can't trade fractions kid
 
-    time_to_close = (Lemon.next_market_closing()-datetime.now().astimezone()).total_seconds()
-    if time_to_close < config['limit-time']: return (False, 'Too close to closing time!' if time_to_close > 0 else 'Market Closed') # don't go for profit 1 hr before close
+    with metrics.stage('market-hours'): time_to_close, time_to_open = market_times()
+    if time_to_close < current.limit_time: return (False, 'Too close to closing time!' if time_to_close > 0 else 'Market Closed') # don't go for profit 1 hr before close
 
-    time_to_open = (Lemon.next_market_availability()-datetime.now().astimezone()).total_seconds()
-    if time_to_open > config['limit-time']: return (False, 'Too far from opening time.') # don't try more than 1 hour before market start
+    if time_to_open > current.limit_time: return (False, 'Too far from opening time.') # don't try more than 1 hour before market start
 
-    # sell
-    held_quantity = HeldTradeable(tradeable.isin, account).get_amount()
-    sell_quantity = min(quantity, held_quantity) if not config['nuke'] else held_quantity
-    try: account.create_sell_order(tradeable, quantity=sell_quantity)
-    except HTTPError as e: return(False, 'HTTPError when creating sell order for {0}: {1} {2}'.format(tradeable.name, e.errno, e.strerror))
-    
-    def buy_later():
-        try: account.create_buy_order(tradeable, quantity=quantity)
-        except ValueError:
-            if config['verbose']: print('Error buying {0} {1} after selling short'.format(tradeable.name, quantity))
-        except HTTPError as e: 
-            if config['verbose']: print('HTTPError buying {0} after selling short: {1} {2}'.format(tradeable.name, e.errno, e.strerror))
-    
-    timer = StoppableTimer(time_to_close-config['limit-time'], buy_later)
-    scheduled_trades.append(timer)
+    # sell (if any are held, which is checked once the orders are netted)
+    intents.add(tradeable, 'sell', quantity, sell_all=current.sell_all, close_out=(time.time()+time_to_close-current.limit_time, False), source=archive.get('id'))
+    archive.append('intents', {'isin': tradeable.isin, 'side': 'sell', 'quantity': quantity, 'all': current.sell_all})
     return (True, 'Executing bearish strategy with a quantity of {0}'.format(quantity))
 
+def reload_config(new_config:dict, twtr:Twitter=None):
+    """
+    Swap in the trading options of a changed config.yml. Everything else still needs a restart
+    """
+    global policy
+    new_policy = TradingPolicy(new_config)
+    old_policy, policy = policy, new_policy
+    for key in ('match', 'weighted', 'limit', 'limits', 'limit-time', 'nuke', 'users', 'denylist'): config[key] = new_config[key]
+    if config['verbose']: print('Now trading with match {0}, weighted {1}, limit {2} ({3} per-ISIN), {4} denied'.format(
+        policy.match, policy.weighted, policy.limit, len(policy.limits), len(policy.denied_names)+len(policy.denied_isins)))
+
+    # tweets from unfollowed users are dropped right away, but twitter only sends new ones after reconnecting
+    if twtr != None and old_policy != None and policy.users != old_policy.users:
+        added = twtr.update_follows(policy.users)
+        if added and config['reload'].get('reconnect-on-follow', False): twtr.close_stream()
+        elif added: print('Following {0} more users from the next reconnect'.format(len(added)))
+
 if __name__ == '__main__':
     config = load_config(KEY_FILE)
+    policy = TradingPolicy(config)
+
+    # time every stage of every tweet if asked to
+    if config['metrics'].get('enabled', False):
+        metrics.enabled = True
+        metrics.slow_tweet = config['metrics'].get('slow-tweet')
+        metrics.start_reporting(interval=config['metrics'].get('interval', 300), path=config['metrics'].get('file'), port=config['metrics'].get('port'), log=config['verbose'])
+
+    # keep every handled payload and what was decided about it
+    if config['archive'].get('enabled', False):
+        options = config['archive']
+        archive.start(options.get('path', './archive'), segment_size=options.get('segment-size', 64*1024*1024), batch_size=options.get('batch-size', 256),
+            flush_interval=options.get('flush-interval', 1), max_pending=options.get('max-pending', 100000))
+
+    # only go to the network for nltk data if asked to, and load the tagger and VADER
+    # from the pickled cache while the stream connects
+    nlp_analysis.allow_downloads = not config['startup'].get('offline-nlp', False)
+    nlp_warmup = Thread(target=nlp_analysis.prewarm, kwargs={'cache_path': config['startup'].get('nlp-cache')}, daemon=True)
+    nlp_warmup.start()
+    if config['startup'].get('wait-for-nlp', False): nlp_warmup.join()
 
     # load up our lemon.markets account
     account = Lemon.select_account(config['lemon'], config['account-name'])
     initial_funds = account.get_funds()
     print('Available funds in account "{0}": ${1}'.format(config['account-name'],initial_funds))
 
+    # cache repeated lookups, starting from the last snapshot if there is one
+    caches = make_caches(config['cache'])
+    if config['cache'].get('file'):
+        try: print('Loaded {0} cached lookups'.format(caches.load(config['cache']['file'])))
+        except Exception as e: print('Could not load lookup cache: {0}'.format(e))
+    TextToTradeables.search_cache = caches['lemon']
+    Twitter.cashtag_cache = caches['yahoo']
+
+    # tag and chunk in worker processes if asked to
+    if config['nlp-processes'] > 0:
+        TextToTradeables.pipeline = NounPhrasePipeline(processes=config['nlp-processes'])
+
+    # remember what recent texts were about
+    if config['analysis-cache'].get('enabled', True):
+        analyses = AnalysisCache(ttl=config['analysis-cache'].get('ttl', 6*60*60), max_size=config['analysis-cache'].get('max-size', 1024))
+
+    # search every phrase and cashtag of a tweet concurrently
+    if config['lookup-concurrency'] > 0:
+        TextToTradeables.lookups = LookupEngine(Twitter.cashtag_to_stock, concurrency=config['lookup-concurrency'])
+
+    # load every tradeable once so tweets are searched in memory
+    # (HTTP searches cover for it until it's loaded, unless we wait)
+    # worker processes search a file written from it, so they need it loaded first
+    workers = None
+    worker_processes = config['workers'].get('processes', 0)
+    index_path = config['workers'].get('index', './tradeables.idx')
+    TextToTradeables.catalog = TradeableCatalog(loader=load_tradeables, refresh_interval=config['catalog-refresh'], verbose=config['verbose'],
+        on_load=(lambda catalog: write_index(catalog, index_path)) if worker_processes > 0 else None)
+    TextToTradeables.catalog.start(wait=config['startup'].get('wait-for-catalog', False) or worker_processes > 0)
+    if worker_processes > 0 and not TextToTradeables.catalog.complete:
+        print('Could not load the tradeable catalog, analysing tweets in this process')
+        worker_processes = 0
+
+    # work out market hours locally, checking them against lemon now and then
+    if config['market-hours']:
+        hours = config['market-hours']
+        calendar = MarketCalendar(hours.get('open', '07:30'), hours.get('close', '23:00'), hours.get('timezone', 'Europe/Berlin'), hours.get('extra-holidays', ['12-24', '12-31']),
+            remote_closing=Lemon.next_market_closing, remote_availability=Lemon.next_market_availability, verify_interval=hours.get('verify-interval', 60*60), verbose=config['verbose'])
+        calendar.start()
+
+    quotes, ledger = make_position_tracking(account)
+    ledger.start()
+    intents = make_order_intents(account)
+    intents.start()
+
+    # run close-outs from one thread, picking up any left over from the last run
+    scheduler = TradeScheduler(lambda entry: close_out(account, entry), journal=config['journal'], verbose=config['verbose'])
+    scheduler.start()
+
     # instanciate twitter and set callback
     twtr = Twitter(*config['twitter'])
     twtr.callback = lambda tweet: on_tweet_recieved(account, tweet)
+
+    # pick up changes to the trading options without restarting
+    watcher = ConfigWatcher(KEY_FILE, lambda path: load_config(path), lambda new_config: reload_config(new_config, twtr),
+        interval=config['reload'].get('interval', 5), verbose=config['verbose'])
+    watcher.start()
+
+    # or hand tweets to worker processes, trading on what they find from this one
+    if worker_processes > 0:
+        workers = AnalysisWorkers(index_path, lambda *result: on_analysis_recieved(account, *result), processes=worker_processes,
+            options={'match': config['match'], 'weighted': config['weighted'], 'allow-downloads': nlp_analysis.allow_downloads,
+                     'nlp-cache': config['startup'].get('nlp-cache'), 'reopen-interval': config['workers'].get('reopen-interval', 60)})
+        twtr.callback = workers.submit
     
     # start the stream and hope for the best!
     try:
+        print('Started in {0:.2f}s'.format(time.perf_counter()-started))
         if config['verbose']: print('Opening Stream! Use Control-C to stop!')
         while True:
-            twtr.open_stream(users=config['users'], is_async=False, restrict=True, verbose=config['verbose'])
+            twtr.open_stream(users=list(policy.users), is_async=False, restrict=True, verbose=config['verbose'], ingest=config['ingest'])
             print('Stream closed, attempting to re-open')
     except (OSError, SystemError, KeyboardInterrupt):
         if config['verbose']: print('Attempting to stop gracefully.')
         twtr.close_stream()
     finally:
         print('Stream closed!')
-        # On exit, attempt to cancel all outgoing orders
-        for order in account.get_orders():
-            order.delete()
-            
-        # On exit, attempt to execute all queued orders
-        for task in scheduled_trades:
-            try: task.execute()
-            except: task.cancel()
+        watcher.stop()
+        if workers != None: workers.close()
+
+        # On exit, cancel all outgoing orders and execute all queued ones, in parallel and within the deadline
+        ledger.stop()
+        try: make_shutdown(account).run(config['shutdown'].get('report'))
+        except Exception as e: print('Error shutting down, pending trades are left in the journal: {0!r}'.format(e))
+
+        TextToTradeables.pipeline.close()
+        if TextToTradeables.lookups != None: TextToTradeables.lookups.close()
+
+        # Save the lookup caches so the next start isn't cold
+        if config['cache'].get('file'):
+            try: caches.save(config['cache']['file'])
+            except Exception as e: print('Could not save lookup cache: {0}'.format(e))
+
+        metrics.report(config['metrics'].get('file'), log=config['verbose'])
+        metrics.stop()
+        archive.stop()
 
         # Get and print out the change in funds if verbose
         if config['verbose']:
+            print('Cache stats: {0}'.format(caches.stats()))
             funds = account.get_funds()
             print('Funds gained: {0} ({1}%)'.format(funds-initial_funds, ['', '+'][funds-initial_funds > 0] + str((funds-initial_funds)/initial_funds)))
\ No newline at end of file
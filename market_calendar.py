@@ -0,0 +1,83 @@
+from datetime import datetime, timedelta, time as dtime
+from threading import Thread, Event, Lock
+import holidays, pytz
+
+class MarketCalendar:
+    """
+    Lang & Schwarz session boundaries worked out locally from the configured hours and
+    German holidays, so the trading-window checks don't need lemon.
+    Every verify_interval seconds the local answer is checked against the remote one,
+    and the remote one wins for the rest of that session if they disagree.
+    """
+    def __init__(self, open_time:str='07:30', close_time:str='23:00', timezone:str='Europe/Berlin', extra_holidays:list=('12-24', '12-31'),
+                 remote_closing=None, remote_availability=None, verify_interval:float=60*60, tolerance:float=60, verbose:bool=False):
+        self.open = dtime(*map(int, open_time.split(':')))
+        self.close = dtime(*map(int, close_time.split(':')))
+        self.timezone = pytz.timezone(timezone)
+        self.holidays = holidays.Germany()
+        self.extra_holidays = {tuple(map(int, day.split('-'))) for day in extra_holidays} # (month, day)
+        self.remote_closing = remote_closing; self.remote_availability = remote_availability
+        self.verify_interval = verify_interval; self.tolerance = tolerance
+        self.verbose = verbose
+        self._day = None; self._session = None # today's (open, close), recomputed at the day boundary
+        self._override = None # (closing, availability) from lemon, while it disagrees with us
+        self._lock = Lock()
+        self._stop = Event()
+
+    def is_trading_day(self, day):
+        return day.weekday() < 5 and day not in self.holidays and (day.month, day.day) not in self.extra_holidays
+
+    def session(self, day):
+        if not self.is_trading_day(day): return None
+        return (self.timezone.localize(datetime.combine(day, self.open)), self.timezone.localize(datetime.combine(day, self.close)))
+
+    def _next_session(self, now:datetime):
+        # the session that is open now, or the next one to open
+        day = now.astimezone(self.timezone).date()
+        with self._lock:
+            if self._day != day: self._day, self._session = day, self.session(day)
+            session = self._session
+        if session != None and now < session[1]: return session
+        for _ in range(14):
+            day += timedelta(days=1)
+            session = self.session(day)
+            if session != None: return session
+        raise ValueError('No trading day in the next two weeks')
+
+    def next_closing(self, now:datetime=None):
+        now = now or datetime.now().astimezone()
+        override = self._override
+        if override != None and now < override[0]: return override[0]
+        return self._next_session(now)[1]
+
+    def next_availability(self, now:datetime=None):
+        now = now or datetime.now().astimezone()
+        override = self._override
+        if override != None and now < override[0]: return override[1]
+        return max(self._next_session(now)[0], now)
+
+    def verify(self):
+        """
+        Compare against lemon and let it win if we disagree
+        """
+        now = datetime.now().astimezone()
+        self._override = None
+        closing, availability = self.remote_closing(), self.remote_availability()
+        local_closing, local_availability = self.next_closing(now), self.next_availability(now)
+        if abs((closing-local_closing).total_seconds()) > self.tolerance or abs((max(availability, now)-local_availability).total_seconds()) > self.tolerance:
+            print('Market calendar disagrees with lemon (close {0} vs {1}, open {2} vs {3}), using lemon\'s'.format(local_closing, closing, local_availability, availability))
+            self._override = (closing, availability)
+        elif self.verbose: print('Market calendar agrees with lemon')
+
+    def start(self):
+        if self.remote_closing == None or self.remote_availability == None or self.verify_interval <= 0: return
+        Thread(target=self._verify_loop, daemon=True).start()
+
+    def _verify_loop(self):
+        while True:
+            try: self.verify()
+            except Exception as e: print('Could not verify market calendar: {0!r}'.format(e))
+            if self._stop.wait(self.verify_interval): return
+
+    def stop(self):
+        self._stop.set()
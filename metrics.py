@@ -0,0 +1,145 @@
+from collections import deque
+from contextlib import contextmanager
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from threading import Thread, Event, Lock, local
+import json, time
+
+class _NullStage:
+    # returned instead of a real stage while disabled, so instrumented code costs almost nothing
+    def __enter__(self): return self
+    def __exit__(self, *exc): return False
+
+_null_stage = _NullStage()
+
+def percentile(values:list, pct:float):
+    if len(values) <= 0: return None
+    return values[min(int(round(pct/100*(len(values)-1))), len(values)-1)]
+
+class Metrics:
+    """
+    Rolling per-stage latency histograms, counters and gauges for the tweet-to-order path.
+    Stages entered on a thread between begin() and end() also form that tweet's trace,
+    which is logged if the whole tweet took longer than slow_tweet seconds.
+    """
+    def __init__(self, enabled:bool=False, window:int=2048, slow_tweet:float=None):
+        self.enabled = enabled
+        self.window = window
+        self.slow_tweet = slow_tweet
+        self.started = time.time()
+        self._timings = dict() # stage -> deque of seconds
+        self._counters = dict()
+        self._gauges = dict() # name -> deque of values, e.g. queue depths
+        self._lock = Lock()
+        self._local = local()
+        self._stop = Event()
+
+    def observe(self, name:str, seconds:float):
+        if not self.enabled: return
+        with self._lock:
+            timings = self._timings.get(name)
+            if timings == None: timings = self._timings[name] = deque(maxlen=self.window)
+            timings.append(seconds)
+        trace = getattr(self._local, 'trace', None)
+        if trace != None: trace.append((name, seconds))
+
+    def count(self, name:str, n:int=1):
+        if not self.enabled: return
+        with self._lock: self._counters[name] = self._counters.get(name, 0) + n
+
+    def gauge(self, name:str, value:float):
+        # a level rather than a duration, summarised as is instead of in milliseconds
+        if not self.enabled: return
+        with self._lock:
+            values = self._gauges.get(name)
+            if values == None: values = self._gauges[name] = deque(maxlen=self.window)
+            values.append(value)
+
+    def stage(self, name:str):
+        if not self.enabled: return _null_stage
+        return self._stage(name)
+
+    @contextmanager
+    def _stage(self, name:str):
+        start = time.perf_counter()
+        try: yield
+        finally: self.observe(name, time.perf_counter()-start)
+
+    def begin(self, enqueued:float=None):
+        """
+        Start timing a tweet on this thread. enqueued is the perf_counter() it was queued at
+        """
+        if not self.enabled: return
+        self._local.trace = list()
+        self._local.started = time.perf_counter()
+        if enqueued != None: self.observe('queued', self._local.started-enqueued)
+        self._local.enqueued = enqueued if enqueued != None else self._local.started
+
+    def end(self, name:str='tweet'):
+        if not self.enabled or getattr(self._local, 'trace', None) == None: return
+        trace, self._local.trace = self._local.trace, None
+        total = time.perf_counter()-self._local.enqueued
+        self.observe(name, total)
+        self.count(name)
+        if self.slow_tweet != None and total > self.slow_tweet:
+            print('Slow tweet ({0:.0f}ms): {1}'.format(total*1000, ', '.join('{0} {1:.0f}ms'.format(n, s*1000) for n, s in trace)))
+
+    def summary(self):
+        with self._lock:
+            timings = {name: sorted(values) for name, values in self._timings.items()}
+            counters = dict(self._counters)
+            gauges = {name: (values[-1], sorted(values)) for name, values in self._gauges.items()}
+        return {
+            'uptime': time.time()-self.started,
+            'counters': counters,
+            'stages': {name: {'count': len(values), 'p50': percentile(values, 50), 'p90': percentile(values, 90),
+                              'p99': percentile(values, 99), 'max': values[-1] if values else None} for name, values in timings.items()},
+            'gauges': {name: {'last': last, 'p50': percentile(values, 50), 'p99': percentile(values, 99), 'max': values[-1]} for name, (last, values) in gauges.items()},
+        }
+
+    def format_summary(self):
+        summary = self.summary()
+        lines = ['Metrics after {0:.0f}s: {1}'.format(summary['uptime'], ', '.join('{0}={1}'.format(k, v) for k, v in sorted(summary['counters'].items())))]
+        for name, stage in sorted(summary['stages'].items()):
+            lines.append('\t{0}: n={1} p50={2:.1f}ms p90={3:.1f}ms p99={4:.1f}ms max={5:.1f}ms'.format(name, stage['count'], *(stage[k]*1000 for k in ('p50', 'p90', 'p99', 'max'))))
+        for name, gauge in sorted(summary['gauges'].items()):
+            lines.append('\t{0}: last={1} p50={2} p99={3} max={4}'.format(name, gauge['last'], gauge['p50'], gauge['p99'], gauge['max']))
+        return '\n'.join(lines)
+
+    def start_reporting(self, interval:float=300, path:str=None, port:int=None, log:bool=True):
+        """
+        Periodically print a summary and/or write it to path, and serve it on localhost:port
+        """
+        if not self.enabled: return
+        if port:
+            metrics = self
+            class Handler(BaseHTTPRequestHandler):
+                def do_GET(self):
+                    body = json.dumps(metrics.summary()).encode()
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'application/json')
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                def log_message(self, *args): pass
+            self._server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+            Thread(target=self._server.serve_forever, daemon=True).start()
+        if interval > 0 and (path or log):
+            Thread(target=self._report_loop, args=(interval, path, log), daemon=True).start()
+
+    def _report_loop(self, interval:float, path:str, log:bool):
+        while not self._stop.wait(interval):
+            self.report(path, log)
+
+    def report(self, path:str=None, log:bool=True):
+        if not self.enabled: return
+        if log: print(self.format_summary())
+        if path:
+            with open(path, 'w') as file: json.dump(self.summary(), file, indent=2)
+
+    def stop(self):
+        self._stop.set()
+        server = getattr(self, '_server', None)
+        if server != None: server.shutdown()
+
+# shared by every module, enabled from main.py
+metrics = Metrics()
@@ -2,117 +2,224 @@ from lemon import Lemon
 from Levenshtein import distance
 import nltk
 
-# silently grab all nltk dependencies
-nltk.download('averaged_perceptron_tagger', quiet=True)
-nltk.download('wordnet', quiet=True)
-nltk.download('vader_lexicon',quiet=True)
-nltk.download('stopwords',quiet=True)
-
 from requests.exceptions import HTTPError
-from nltk.sentiment.vader import SentimentIntensityAnalyzer
-from nltk.corpus import wordnet, stopwords
+from concurrent.futures import ProcessPoolExecutor
+from threading import Lock
+from metrics import metrics
+from archive import archive
+from catalog import suffix_search
+import multiprocessing, os, pickle
+
+# nltk data each component needs, as (path to look for locally, package to download)
+resources = {
+    'tagger': ('taggers/averaged_perceptron_tagger', 'averaged_perceptron_tagger'),
+    'vader': ('sentiment/vader_lexicon.zip', 'vader_lexicon'),
+    'stopwords': ('corpora/stopwords', 'stopwords'),
+}
+allow_downloads = True # set to False to fail instead of going to the network for missing data
+
+def ensure_resource(name:str):
+    path, package = resources[name]
+    try: nltk.data.find(path)
+    except LookupError:
+        if not allow_downloads: raise
+        nltk.download(package, quiet=True)
+
+# components are built on first use (or by prewarm), so importing this costs no I/O
+_components = dict()
+_components_lock = Lock()
+
+def _build(name:str):
+    ensure_resource(name)
+    if name == 'tagger':
+        from nltk.tag.perceptron import PerceptronTagger
+        return PerceptronTagger()
+    if name == 'vader':
+        from nltk.sentiment.vader import SentimentIntensityAnalyzer
+        return SentimentIntensityAnalyzer()
+    if name == 'stopwords':
+        from nltk.corpus import stopwords
+        return set(stopwords.words('english'))
+
+def component(name:str):
+    try: return _components[name]
+    except KeyError: pass
+    with _components_lock:
+        if name not in _components: _components[name] = _build(name)
+        return _components[name]
+
+def prewarm(names=('tagger', 'vader'), cache_path:str=None):
+    """
+    Build the given components now, from a pickled copy at cache_path if there is one
+    """
+    if cache_path and os.path.exists(cache_path):
+        try:
+            with open(cache_path, 'rb') as file: cached = pickle.load(file)
+            with _components_lock:
+                for name in names:
+                    if name in cached: _components.setdefault(name, cached[name])
+        except Exception as e: print('Could not load nlp cache: {0!r}'.format(e))
+    built = {name: component(name) for name in names}
+    if cache_path and not os.path.exists(cache_path):
+        # every worker process may get here at once, so each writes a file of its own
+        temp = '{0}.{1}.tmp'.format(cache_path, os.getpid())
+        try:
+            with open(temp, 'wb') as file: pickle.dump(built, file, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temp, cache_path)
+        except Exception as e:
+            print('Could not write nlp cache: {0!r}'.format(e))
+            try: os.remove(temp)
+            except OSError: pass
+
+class NounPhrasePipeline:
+    """
+    Tokenizer and chunker compiled once and reused for every tweet.
+    With processes > 0, tagging and chunking run in a pool of warmed worker
+    processes, so concurrent tweets aren't serialized by the GIL.
+    """
+    sentence_re = r'(?:(?:[A-Z])(?:.[A-Z])+.?)|(?:\w+(?:-\w+)*)|(?:\$?\d+(?:.\d+)?%?)|(?:...|)(?:[][.,;"\'?():-_`])'
+    grammar = r"""
+        NBAR:
+            {<NN.*|JJ>*<NN.*>}  # Nouns and Adjectives, terminated with Nouns
+            
+        NP:
+            {<NBAR><IN><NBAR>}  # Above, connected with in/of/etc...
+            {<NBAR>}
+    """
+
+    def __init__(self, processes:int=0):
+        self.tokenizer = nltk.RegexpTokenizer(NounPhrasePipeline.sentence_re)
+        self.chunker = nltk.RegexpParser(NounPhrasePipeline.grammar)
+        self.pool = None
+        if processes > 0:
+            # spawned, since a fork could copy _components_lock while prewarm's thread holds it
+            self.pool = ProcessPoolExecutor(processes, mp_context=multiprocessing.get_context('spawn'), initializer=_init_pipeline_worker, initargs=(allow_downloads, ))
+            for _ in range(processes): self.pool.submit(_pipeline_worker_parse, list()) # spawn the workers now
+
+    @property
+    def tagger(self):
+        # nltk.pos_tag unpickles a new tagger on every call, so share one
+        return component('tagger')
 
-lemmatizer = nltk.WordNetLemmatizer(); next(wordnet.words()) # I have no idea why next(wordnet.words()) fixes threading, but it does.
-stemmer = nltk.stem.porter.PorterStemmer()
-stop_words = set(stopwords.words('english'))
+    @staticmethod
+    def normalise(word):
+        return word.lower()
+
+    def phrases(self, tagged):
+        tree = self.chunker.parse(tagged)
+        leaves = (subtree.leaves() for subtree in tree.subtrees(filter=lambda t: t.label()=='NP'))
+        return [' '.join(self.normalise(w) for w,t in leaf) for leaf in leaves]
+
+    def parse(self, text):
+        if self.pool != None: return self.pool.submit(_pipeline_worker_parse, [str(text)]).result()[0]
+        return self.phrases(self.tagger.tag(self.tokenizer.tokenize(str(text))))
+
+    def parse_batch(self, texts, chunk_size:int=4):
+        texts = [str(text) for text in texts]
+        if self.pool != None:
+            chunks = [texts[i:i+chunk_size] for i in range(0, len(texts), chunk_size)]
+            return [phrases for chunk in self.pool.map(_pipeline_worker_parse, chunks) for phrases in chunk]
+        tagged = self.tagger.tag_sents([self.tokenizer.tokenize(text) for text in texts])
+        return [self.phrases(sent) for sent in tagged]
+
+    def close(self):
+        if self.pool != None: self.pool.shutdown(wait=True)
+
+_worker_pipeline = None
+def _init_pipeline_worker(downloads:bool=True):
+    # build the pipeline and load the tagger before the first tweet arrives
+    global _worker_pipeline, allow_downloads
+    allow_downloads = downloads
+    _worker_pipeline = NounPhrasePipeline()
+    _worker_pipeline.parse_batch(['Warm up the tagger'])
+
+def _pipeline_worker_parse(texts):
+    if _worker_pipeline == None: _init_pipeline_worker()
+    return _worker_pipeline.parse_batch(texts)
 
 class TextToTradeables:
-    sia = SentimentIntensityAnalyzer()
+    pipeline = NounPhrasePipeline() # replace with NounPhrasePipeline(processes=n) to use more cores
+    catalog = None # set to a loaded TradeableCatalog to search in memory instead of over HTTP
+    search_cache = None # set to a LookupCache to remember HTTP search results
+    lookups = None # set to a LookupEngine to search all noun phrases concurrently
 
     @staticmethod
     def process_text(text, search_for:str='stock', similarity_cutoff:int=1.4, min_noun_length:int=4):
         text = str(text)
+        if TextToTradeables.lookups != None:
+            return TextToTradeables.lookups.process_text(text, search_for=search_for, similarity_cutoff=similarity_cutoff, min_noun_length=min_noun_length)
 
         companies = list()
-        entities = TextToTradeables.get_noun_phrases(text)
-        for entity in entities:
-            if min_noun_length > 0 and len(str(entity).replace(' ','')) < min_noun_length: continue
-            
-            ds = TextToTradeables.deep_search(str(entity), search_for=search_for)
-            if ds[0] != None and ds[1] < similarity_cutoff: companies.append(ds)
+        with metrics.stage('noun-phrases'): entities = TextToTradeables.get_noun_phrases(text)
+        with metrics.stage('search'):
+            for entity in entities:
+                if min_noun_length > 0 and len(str(entity).replace(' ','')) < min_noun_length: continue
+                
+                ds = TextToTradeables.deep_search(str(entity), search_for=search_for, similarity_cutoff=similarity_cutoff)
+                if ds[0] != None and ds[1] < similarity_cutoff: companies.append(ds)
         
         return companies
     
     @staticmethod
     def get_noun_phrases(text):
-        sentence_re = r'(?:(?:[A-Z])(?:.[A-Z])+.?)|(?:\w+(?:-\w+)*)|(?:\$?\d+(?:.\d+)?%?)|(?:...|)(?:[][.,;"\'?():-_`])'
-        grammar = r"""
-            NBAR:
-                {<NN.*|JJ>*<NN.*>}  # Nouns and Adjectives, terminated with Nouns
-                
-            NP:
-                {<NBAR><IN><NBAR>}  # Above, connected with in/of/etc...
-                {<NBAR>}
-        """
-        chunker = nltk.RegexpParser(grammar)
-
-        def leaves(tree):
-            for subtree in tree.subtrees(filter = lambda t: t.label()=='NP'):
-                yield subtree.leaves()
-
-        def normalise(word):
-            word = word.lower()
-            #word = lemmatizer.lemmatize(word)
-            return word
-
-        def get_terms(tree):
-            for leaf in leaves(tree):
-                term = [ normalise(w) for w,t in leaf ]
-                yield term
-
-        def get_phrases(text):
-            toks = nltk.regexp_tokenize(text, sentence_re)
-            postoks = nltk.tag.pos_tag(toks)
-            tree = chunker.parse(postoks)
-            
-            terms = get_terms(tree)
-            phrases = [" ".join(term) for term in terms]
-            return phrases
-        return get_phrases(text)
+        phrases = TextToTradeables.pipeline.parse(text)
+        if archive.enabled: archive.note('phrases', [str(phrase) for phrase in phrases])
+        return phrases
+
+    @staticmethod
+    def get_noun_phrases_batch(texts):
+        return TextToTradeables.pipeline.parse_batch(texts)
 
     @staticmethod
-    def deep_search(query:str, search_for='stock'):
+    def deep_search(query:str, search_for='stock', similarity_cutoff:float=None):
         if query == None or len(query) <= 0: return None, None
-        try: tradeable = Lemon.search_for_tradeable(query, search_type='name', search_for=search_for)
+        catalog = TextToTradeables.catalog
+        if catalog != None and len(catalog) > 0:
+            result = TextToTradeables.catalog_search(catalog, query, search_for=search_for)
+            # a complete catalog is authoritative, a partial one only saves us the round trip on a good enough hit
+            if catalog.complete or TextToTradeables.catalog_hit(result, similarity_cutoff): return result
+
+        metrics.count('http-search')
+        try: tradeable = TextToTradeables.search_for_tradeable(query, search_type='name', search_for=search_for)
         except HTTPError: tradeable = None
         while tradeable == None and ' ' in query and len(query) > 1:
             query = query[query.find(' ')+1:]
+            metrics.count('http-search')
             try:
-                tradeable = Lemon.search_for_tradeable(query, search_type='name', search_for=search_for)
+                tradeable = TextToTradeables.search_for_tradeable(query, search_type='name', search_for=search_for)
             except HTTPError:
                 return None, None
 
         if tradeable == None: return None, None
+        if catalog != None: catalog.add(tradeable)
         return tradeable, distance(tradeable.name.lower(), query.lower())/len(query)
+
+    @staticmethod
+    def search_for_tradeable(query:str, **kwargs):
+        # Lemon.search_for_tradeable, through the search cache if there is one
+        cache = TextToTradeables.search_cache
+        if cache == None: return Lemon.search_for_tradeable(query, **kwargs)
+        key = (str(query).lower().strip(), ) + tuple(sorted(kwargs.items()))
+        return cache.get_or_load(key, lambda: Lemon.search_for_tradeable(query, **kwargs))
+
+    @staticmethod
+    def catalog_hit(result, similarity_cutoff:float=None):
+        return result[0] != None and (similarity_cutoff == None or result[1] < similarity_cutoff)
+
+    @staticmethod
+    def catalog_search(catalog, query:str, search_for='stock'):
+        # same suffix walk as the HTTP search, but in memory
+        return suffix_search(catalog.search, query, search_for=search_for)
     
     @staticmethod
     def get_sentiment(text:str):
-        return TextToTradeables.sia.polarity_scores(str(text))['compound']
+        return component('vader').polarity_scores(str(text))['compound']
     
     @staticmethod
     def remove_stopwords(text:str):
+        stop_words = component('stopwords')
         return ' '.join(filter(lambda w: w not in stop_words, text.split(' ')))
 
-from threading import Timer
-import time
-# we cannot force threading.Timer to execute early, so we must wrap
-# I had no idea where to put this. It messes up the elegance of main.py, so just deal with it here.
-class StoppableTimer:
-    def __init__(self, interval, function, args:list=list(), kwargs:dict=dict()):
-        self.function = function; self.args = args; self.kwargs = kwargs
-        self.started = time.time()
-        self.thread = Timer(interval, self.execute)
-        self.thread.start()
-    def is_alive(self):
-        if not self.thread: return False
-        return self.thread.is_alive()
-    def execute(self):
-        if self.is_alive(): self.thread.cancel()
-        self.function(*self.args, **self.kwargs)
-    def cancel(self):
-        if self.is_alive(): self.thread.cancel()
-        
-
 if __name__ == "__main__":
     txts = ["Good Apple Inc. will do terrible today. Absolutely horrendous. Daimler will do fine. asdfa will fail"]
     txts.append("Biden has repeatedly failed to answer legitimate questions that American voters should know the answers to before voting while Trump takes every interview in the world. Chris Wallace had the opportunity tonight to get more information to the American voter on Biden and he failed")
@@ -130,4 +237,4 @@ if __name__ == "__main__":
                 print('\t{0}'.format(ds))
                 print('\t{0}'.format(ds[0].name))
                 print('\t{0}'.format(ds[0].type))
-        print('Opinion on these stocks: {0}'.format(TextToTradeables.sia.polarity_scores(txt)['compound']))
\ No newline at end of file
+        print('Opinion on these stocks: {0}'.format(TextToTradeables.get_sentiment(txt)))
\ No newline at end of file
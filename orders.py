@@ -0,0 +1,158 @@
+from threading import Thread, Condition
+from requests.exceptions import HTTPError
+from metrics import metrics
+from archive import archive
+import heapq, time
+
+class OrderIntents:
+    """
+    Collects buy and sell intents per ISIN for a short window, then nets them into one order.
+    Three tweets about the same company become one buy, and a buy and sell of the same
+    stock inside the window cancel out instead of costing two orders.
+    """
+    def __init__(self, submit, holdings, window:float=2, limit:float=None, cost=None, close_out=None, verbose:bool=False):
+        self.submit = submit # submit(tradeable, side, quantity) places the real order
+        self.close_out = close_out # close_out(tradeable, side, quantity, when, sell_all) schedules the trade undoing a submitted order
+        self.holdings = holdings # holdings(isin) returns how many are held
+        self.cost = cost or (lambda tradeable: tradeable.get_cost())
+        self.window = window
+        self.limit = limit # most to spend on one (netted) buy, or limit(isin) giving it per ISIN
+        self.verbose = verbose
+        self._intents = dict() # isin -> list of (side, quantity, sell_all, close_out, source)
+        self._tradeables = dict() # isin -> tradeable
+        self._deadlines = list() # heap of (deadline, isin)
+        self._due = dict() # isin -> deadline of its current batch
+        self._cond = Condition()
+        self._running = False
+        self._thread = None
+
+    def __len__(self):
+        return len(self._intents)
+
+    def add(self, tradeable, side:str, quantity:int, sell_all:bool=False, close_out:tuple=None, source:str=None):
+        """
+        close_out is (when, sell_all) of the opposite trade to schedule once this one is submitted,
+        source the id of the tweet that asked for it
+        """
+        metrics.count('order-intents')
+        with self._cond:
+            intents = self._intents.get(tradeable.isin)
+            if intents == None:
+                intents = self._intents[tradeable.isin] = list()
+                self._tradeables[tradeable.isin] = tradeable
+                self._due[tradeable.isin] = time.time()+self.window
+                heapq.heappush(self._deadlines, (self._due[tradeable.isin], tradeable.isin))
+                self._cond.notify()
+            intents.append((side, quantity, sell_all, close_out, source))
+        if not self._running or self.window <= 0: self.flush(tradeable.isin)
+
+    def net(self, tradeable, intents:list):
+        """
+        Returns the single (side, quantity) the intents add up to, or None if they cancel out
+        """
+        buy = sum(intent[1] for intent in intents if intent[0] == 'buy')
+        held = None
+        if any(intent[0] == 'sell' for intent in intents): held = int(self.holdings(tradeable.isin))
+        sell = sum(held if intent[2] else intent[1] for intent in intents if intent[0] == 'sell')
+
+        quantity = buy - sell
+        limit = self.limit(tradeable.isin) if callable(self.limit) else self.limit
+        if quantity > 0 and limit != None:
+            try: quantity = min(quantity, int(limit/self.cost(tradeable)))
+            except ZeroDivisionError: pass
+        if quantity < 0 and held != None: quantity = -min(-quantity, held)
+        if quantity == 0: return None
+        return ('buy', quantity) if quantity > 0 else ('sell', -quantity)
+
+    def flush(self, isin:str=None):
+        """
+        Net and submit the intents for isin, or for every ISIN if None
+        """
+        with self._cond:
+            isins = list(self._intents.keys()) if isin == None else [isin]
+            batches = [(self._tradeables.pop(i), self._intents.pop(i)) for i in isins if i in self._intents]
+            for tradeable, _ in batches: self._due.pop(tradeable.isin, None)
+        for tradeable, intents in batches: self._submit(tradeable, intents)
+        return len(batches)
+
+    def _submit(self, tradeable, intents:list):
+        try: order = self.net(tradeable, intents)
+        except Exception as e:
+            print('Error netting orders for {0}: {1!r}'.format(tradeable.name, e))
+            return
+        sources = [intent[4] for intent in intents if intent[4] != None]
+        if order == None and all(intent[0] == 'sell' for intent in intents):
+            # only sells, so nothing was netted: there just isn't anything held
+            metrics.count('orders-nothing-held')
+            archive.record({'order': {'isin': tradeable.isin, 'name': str(tradeable.name), 'nothing-held': True, 'intents': len(intents), 'tweets': sources}})
+            if self.verbose: print('Nothing of {0} held to sell'.format(tradeable.name))
+            return
+        if order == None:
+            metrics.count('orders-netted-out')
+            archive.record({'order': {'isin': tradeable.isin, 'name': str(tradeable.name), 'netted-out': True, 'intents': len(intents), 'tweets': sources}})
+            if self.verbose: print('{0} orders for {1} cancelled each other out'.format(len(intents), tradeable.name))
+            return
+
+        side, quantity = order
+        metrics.count('orders-submitted')
+        try:
+            with metrics.stage(side + '-order'): self.submit(tradeable, side, quantity)
+            if self.verbose and len(intents) > 1: print('Merged {0} orders for {1} into one {2} of {3}'.format(len(intents), tradeable.name, side, quantity))
+        except (HTTPError, ValueError) as e:
+            archive.record({'order': {'isin': tradeable.isin, 'name': str(tradeable.name), 'side': side, 'quantity': quantity, 'ok': False, 'error': repr(e), 'intents': len(intents), 'tweets': sources}})
+            print('Error creating {0} order for {1} ({2}): {3!r}'.format(side, tradeable.name, quantity, e))
+            return
+        archive.record({'order': {'isin': tradeable.isin, 'name': str(tradeable.name), 'side': side, 'quantity': quantity, 'ok': True, 'intents': len(intents), 'tweets': sources}})
+        if self.close_out != None: self._close_out(tradeable, side, quantity, intents)
+
+    def _close_out(self, tradeable, side:str, quantity:int, intents:list):
+        # undo only what the order really traded, and only for the intents that asked for it
+        asked = [(q, sell_all, close_out) for s, q, sell_all, close_out, _ in intents if s == side and close_out != None]
+        if len(asked) <= 0: return
+        if not any(sell_all for _, sell_all, _ in asked): quantity = min(quantity, sum(q for q, _, _ in asked))
+        when = min(close_out[0] for _, _, close_out in asked)
+        try: self.close_out(tradeable, 'sell' if side == 'buy' else 'buy', quantity, when, any(close_out[1] for _, _, close_out in asked))
+        except Exception as e: print('Error scheduling the close-out of {0}: {1!r}'.format(tradeable.name, e))
+
+    def _loop(self):
+        while True:
+            with self._cond:
+                while self._running:
+                    wait = self._deadlines[0][0]-time.time() if len(self._deadlines) > 0 else None
+                    if wait != None and wait <= 0: break
+                    self._cond.wait(wait)
+                if not self._running: return
+                deadline, isin = heapq.heappop(self._deadlines)
+                if self._due.get(isin) != deadline: continue # already flushed
+            self.flush(isin)
+
+    def start(self):
+        with self._cond: self._running = True
+        self._thread = Thread(target=self._loop, daemon=True)
+        self._thread.start()
+
+    def drop_opening(self):
+        """
+        Forget the waiting intents that open a position (the ones with a close-out), returning how many
+        """
+        dropped = 0
+        with self._cond:
+            for isin in list(self._intents.keys()):
+                kept = [intent for intent in self._intents[isin] if intent[3] == None]
+                dropped += len(self._intents[isin])-len(kept)
+                if len(kept) > 0: self._intents[isin] = kept
+                else:
+                    del self._intents[isin], self._tradeables[isin]
+                    self._due.pop(isin, None)
+        return dropped
+
+    def stop(self, flush:bool=True, timeout:float=None):
+        """
+        Stop the window thread and submit everything still waiting, unless not flush.
+        timeout bounds the wait for an order the thread is still submitting
+        """
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        if self._thread != None: self._thread.join(timeout)
+        return self.flush() if flush else 0
@@ -0,0 +1,76 @@
+from threading import Thread, Event
+from catalog import normalise_name
+import os, re
+
+isin_re = re.compile(r'^[a-z]{2}[a-z0-9]{9}[0-9]$', re.IGNORECASE)
+
+class TradingPolicy:
+    """
+    The options that decide what gets traded, compiled once per config load so every
+    tweet only does set lookups and comparisons. A policy never changes once built:
+    a new config.yml compiles a new one, which replaces it with a single assignment.
+    """
+    def __init__(self, config:dict):
+        self.match = float(config['match'])
+        self.weighted = float(config['weighted'])
+        self.limit = float(config['limit'])
+        self.limits = {str(isin).upper(): float(limit) for isin, limit in config.get('limits', dict()).items()} # isin -> limit
+        self.limit_time = config['limit-time']
+        self.sell_all = bool(config['nuke'])
+        self.users = tuple(config['users'])
+        # denylist entries that look like ISINs block that ISIN, anything else a name
+        self.denied_isins = frozenset(str(entry).upper() for entry in config['denylist'] if isin_re.match(str(entry).strip()))
+        self.denied_names = frozenset(normalise_name(entry) for entry in config['denylist'] if not isin_re.match(str(entry).strip()))
+
+    def allows(self, tradeable):
+        return tradeable.isin not in self.denied_isins and normalise_name(tradeable.name) not in self.denied_names
+
+    def limit_for(self, isin:str):
+        return self.limits.get(isin, self.limit)
+
+    def select(self, stocks:list):
+        """
+        The (tradeable, similarity) pairs that pass the thresholds and denylist, once per ISIN
+        """
+        seen, selected = set(), list()
+        for tradeable, similarity in stocks:
+            if tradeable.isin in seen or similarity >= self.match or similarity*len(tradeable.name) > self.weighted or not self.allows(tradeable): continue
+            seen.add(tradeable.isin)
+            selected.append((tradeable, similarity))
+        return selected
+
+class ConfigWatcher:
+    """
+    Reloads the config file when it changes, handing the new config to on_change.
+    A config that doesn't load is reported and the old one kept.
+    """
+    def __init__(self, path:str, load, on_change, interval:float=5, verbose:bool=False):
+        self.path = path
+        self.load = load # load(path) returns the parsed config
+        self.on_change = on_change
+        self.interval = interval
+        self.verbose = verbose
+        self.mtime = os.stat(path).st_mtime
+        self._stop = Event()
+
+    def check(self):
+        mtime = os.stat(self.path).st_mtime
+        if mtime == self.mtime: return False
+        self.mtime = mtime
+        try: self.on_change(self.load(self.path))
+        except (Exception, SystemExit) as e: # load_config quits on missing keys
+            print('Could not reload {0}, keeping the old config: {1!r}'.format(self.path, e))
+            return False
+        if self.verbose: print('Reloaded {0}'.format(self.path))
+        return True
+
+    def start(self):
+        if self.interval > 0: Thread(target=self._loop, daemon=True).start()
+
+    def _loop(self):
+        while not self._stop.wait(self.interval):
+            try: self.check()
+            except OSError as e: print('Could not check {0}: {1!r}'.format(self.path, e))
+
+    def stop(self):
+        self._stop.set()
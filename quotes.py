@@ -0,0 +1,68 @@
+from threading import Thread, Event, Lock
+from cache import LookupCache
+
+class QuoteCache:
+    """
+    Prices per ISIN, at most max_age seconds old
+    """
+    def __init__(self, max_age:float=30, max_size:int=1024):
+        self.cache = LookupCache(ttl=max_age, negative_ttl=0, max_size=max_size)
+
+    def cost(self, tradeable):
+        return self.cache.get_or_load(tradeable.isin, tradeable.get_cost)
+
+    def stats(self):
+        return self.cache.stats()
+
+class PositionLedger:
+    """
+    How many of each ISIN we hold, kept up to date from the orders we place.
+    Unknown ISINs are loaded on first use, and every known ISIN is reconciled
+    with the account in the background every reconcile_interval seconds.
+    """
+    def __init__(self, loader, reconcile_interval:float=5*60, verbose:bool=False):
+        self.loader = loader # loader(isin) returns the amount held according to the account
+        self.reconcile_interval = reconcile_interval
+        self.verbose = verbose
+        self._held = dict() # isin -> quantity
+        self._lock = Lock()
+        self._stop = Event()
+
+    def get(self, isin:str):
+        with self._lock:
+            if isin in self._held: return self._held[isin]
+        held = int(self.loader(isin))
+        with self._lock: return self._held.setdefault(isin, held)
+
+    def record(self, isin:str, side:str, quantity:int):
+        self.get(isin) # load it first, so the update below is one locked read-modify-write
+        with self._lock: self._held[isin] = max(self._held[isin] + (quantity if side == 'buy' else -quantity), 0)
+
+    def positions(self):
+        with self._lock: return dict(self._held)
+
+    def reconcile(self):
+        """
+        Replace every known position with the account's, returning {isin: (ours, theirs)} where they differed
+        """
+        drift = dict()
+        for isin in list(self.positions().keys()):
+            with self._lock: before = self._held.get(isin)
+            actual = int(self.loader(isin))
+            with self._lock:
+                if self._held.get(isin) != before: continue # an order was recorded meanwhile, check it next time
+                if before != actual: drift[isin] = (before, actual)
+                self._held[isin] = actual
+        if len(drift) > 0 and self.verbose: print('Reconciled positions: {0}'.format(drift))
+        return drift
+
+    def start(self):
+        if self.reconcile_interval > 0: Thread(target=self._reconcile_loop, daemon=True).start()
+
+    def _reconcile_loop(self):
+        while not self._stop.wait(self.reconcile_interval):
+            try: self.reconcile()
+            except Exception as e: print('Could not reconcile positions: {0!r}'.format(e))
+
+    def stop(self):
+        self._stop.set()
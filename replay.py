@@ -0,0 +1,144 @@
+# Replay a recorded stream through the real tweet handling against fake_lemon.
+# Usage: python3 replay.py tweets.jsonl catalog.json [--speed 0] [--match 0.8] [--weighted 4.5]
+# tweets.jsonl holds one raw stream payload per line, catalog.json looks like
+# {"tradeables": [{"name": "APPLE INC.", "isin": "US0378331005", "type": "stock", "price": 100}], "prices": {}}
+import sys, json, time, argparse
+from email.utils import parsedate_to_datetime
+from threading import local, Lock
+
+# everything below must see the fake, including main.py and nlp_analysis.py
+import fake_lemon
+sys.modules['lemon'] = fake_lemon
+sys.modules['dl_lemon'] = fake_lemon
+
+import main
+from fake_lemon import Lemon
+from nlp_analysis import TextToTradeables
+from catalog import TradeableCatalog
+from scheduler import TradeScheduler
+from lookup import LookupEngine
+from cache import AnalysisCache
+from twitter import CallbackStreamListener
+from metrics import percentile
+
+def payload_time(payload:str):
+    # seconds since epoch the tweet was sent, or None for payloads without one
+    try: tweet = json.loads(payload)
+    except ValueError: return None
+    if 'timestamp_ms' in tweet: return int(tweet['timestamp_ms'])/1000
+    try: return parsedate_to_datetime(tweet['created_at']).timestamp()
+    except (KeyError, TypeError, ValueError): return None
+
+class Replay:
+    def __init__(self, payloads:list, num_threads:int=5, speed:float=0, close_out:bool=False):
+        self.payloads = payloads
+        self.close_out = close_out # run the scheduled close-outs once the stream is done
+        self.num_threads = num_threads
+        self.speed = speed # 0 is as fast as possible, 1 is real time, 10 is ten times faster
+        self.latencies = list(); self.errors = 0
+        self._lock = Lock()
+        self._local = local()
+
+    def _callback(self, tweet):
+        self._local.handled = True
+        main.on_tweet_recieved(self.account, tweet)
+
+    def _handle(self, listener, payload:str, enqueued:float):
+        self._local.handled = False
+        try: CallbackStreamListener.handle_data(listener, payload, enqueued)
+        except Exception as e:
+            with self._lock: self.errors += 1
+            print('Error replaying tweet: {0!r}'.format(e))
+        if self._local.handled:
+            with self._lock: self.latencies.append(time.perf_counter()-enqueued)
+
+    def run(self, account):
+        self.account = account
+        main.quotes, main.ledger = main.make_position_tracking(account)
+        main.intents = main.make_order_intents(account)
+        main.intents.start()
+        main.scheduler = TradeScheduler(lambda entry: main.close_out(account, entry))
+        # recorded timestamps are always old by the wall clock, so nothing can be stale in a replay
+        options = dict(main.config['ingest'], num_threads=self.num_threads, max_age=None)
+        if self.speed <= 0: options.update(overflow='block') # replaying as fast as possible shouldn't drop anything
+        listener = CallbackStreamListener(self._callback, swallow_errors=False, filter_users=main.config['users'], **options)
+        listener.handle_data = lambda payload, enqueued: self._handle(listener, payload, enqueued)
+
+        first_sent, started = None, time.perf_counter()
+        for payload in self.payloads:
+            sent = payload_time(payload) if self.speed > 0 else None
+            if sent != None:
+                if first_sent == None: first_sent = sent
+                wait = (sent-first_sent)/self.speed - (time.perf_counter()-started)
+                if wait > 0: time.sleep(wait)
+            listener.on_data(payload)
+        listener.close()
+        self.queue_stats = listener.queue.stats()
+        main.intents.stop()
+        self.duration = time.perf_counter()-started
+
+        # close-outs would run at market close, which never comes in a replay
+        self.scheduled = len(main.scheduler)
+        if self.close_out: main.scheduler.execute_all()
+        else: main.scheduler.stop()
+        main.intents.flush()
+        return self.report()
+
+    def report(self):
+        latencies = sorted(self.latencies) # metrics.percentile expects them sorted
+        return {
+            'payloads': len(self.payloads),
+            'tweets': len(self.latencies),
+            'errors': self.errors,
+            'seconds': self.duration,
+            'tweets-per-second': len(self.latencies)/self.duration if self.duration > 0 else None,
+            'latency': {'p50': percentile(latencies, 50), 'p90': percentile(latencies, 90), 'p99': percentile(latencies, 99), 'max': max(latencies, default=None)},
+            'orders': self.account.orders,
+            'scheduled-close-outs': self.scheduled,
+            'queue': self.queue_stats,
+        }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay recorded tweets against a fake lemon account')
+    parser.add_argument('tweets', help='JSONL file of raw stream payloads')
+    parser.add_argument('catalog', help='JSON file of tradeables and prices')
+    parser.add_argument('--config', default=main.KEY_FILE)
+    parser.add_argument('--speed', type=float, default=0, help='0 for as fast as possible, 1 for real time, >1 to accelerate')
+    parser.add_argument('--threads', type=int, default=5)
+    parser.add_argument('--match', type=float, help='override match-factor')
+    parser.add_argument('--weighted', type=float, help='override weighted-factor')
+    parser.add_argument('--search-latency', type=float, default=0, help='seconds each fake HTTP search takes')
+    parser.add_argument('--close-out', action='store_true', help='execute the trades scheduled for market close at the end')
+    parser.add_argument('--no-catalog', action='store_true', help='search through the (fake) HTTP path only')
+    parser.add_argument('--verbose', action='store_true')
+    parser.add_argument('--output', help='write the report as JSON here')
+    args = parser.parse_args()
+
+    main.config = main.load_config(args.config, require_keys=False)
+    main.config['verbose'] = args.verbose
+    if args.match != None: main.config['match'] = args.match
+    if args.weighted != None: main.config['weighted'] = args.weighted
+    main.policy = main.TradingPolicy(main.config)
+
+    Lemon.load(args.catalog)
+    Lemon.search_latency = args.search_latency
+    if not args.no_catalog:
+        TextToTradeables.catalog = TradeableCatalog(loader=main.load_tradeables, refresh_interval=0)
+        TextToTradeables.catalog.load()
+
+    if main.config['analysis-cache'].get('enabled', True):
+        main.analyses = AnalysisCache(ttl=main.config['analysis-cache'].get('ttl', 6*60*60), max_size=main.config['analysis-cache'].get('max-size', 1024))
+    if main.config['lookup-concurrency'] > 0:
+        TextToTradeables.lookups = LookupEngine(main.Twitter.cashtag_to_stock, concurrency=main.config['lookup-concurrency'])
+
+    with open(args.tweets) as file: payloads = [line.rstrip('\n') for line in file if line.strip()]
+
+    report = Replay(payloads, num_threads=args.threads, speed=args.speed, close_out=args.close_out).run(Lemon.select_account('', 'Replay'))
+    if args.output:
+        with open(args.output, 'w') as file: json.dump(report, file, indent=2)
+
+    print('Replayed {0} payloads ({1} tweets, {2} errors) in {3:.2f}s: {4:.1f} tweets/s'.format(report['payloads'], report['tweets'], report['errors'], report['seconds'], report['tweets-per-second'] or 0))
+    print('Latency p50/p90/p99/max: {0}'.format(' / '.join('{0:.1f}ms'.format(v*1000) if v != None else '-' for v in report['latency'].values())))
+    print('{0} orders, {1} scheduled close-outs'.format(len(report['orders']), report['scheduled-close-outs']))
+    for order in report['orders']:
+        print('\t{side} {quantity} {name} ({isin}) at {price}'.format(**order))
@@ -0,0 +1,144 @@
+from threading import Thread, Condition, Lock
+import heapq, itertools, json, os, time, uuid
+
+class TradeScheduler:
+    """
+    Runs deferred close-out orders from one thread, ordered by a heap on their due time.
+    Every scheduled and finished trade is appended to a journal, so trades still pending
+    when the program dies are picked up again by the next start.
+    """
+    def __init__(self, execute, journal:str=None, verbose:bool=False):
+        self.execute = execute # called with each due entry, returns None or the seconds to put it off by
+        self.journal = journal
+        self.verbose = verbose
+        self.min_deferral = 60 # seconds, so a bad answer from execute can't spin the loop
+        self.tradeables = dict() # id -> tradeable, for entries scheduled by this run
+        self._heap = list()
+        self._pending = dict() # id -> entry
+        self._seq = itertools.count()
+        self._cond = Condition()
+        self._journal_lock = Lock()
+        self._running = False
+        self._thread = None
+        if journal: self._replay()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def pending(self):
+        with self._cond: return list(self._pending.values())
+
+    def _write(self, record:dict):
+        if not self.journal: return
+        with self._journal_lock, open(self.journal, 'a') as file:
+            file.write(json.dumps(record) + '\n')
+            file.flush()
+
+    def _replay(self):
+        if not os.path.exists(self.journal): return
+        pending = dict()
+        with open(self.journal) as file:
+            for line in file:
+                try: record = json.loads(line)
+                except ValueError: continue # half-written line from a crash
+                if record.get('op') == 'add': pending[record['entry']['id']] = record['entry']
+                elif record.get('op') == 'done': pending.pop(record['id'], None)
+
+        # compact the journal down to what's still pending
+        tmp = self.journal + '.tmp'
+        with open(tmp, 'w') as file:
+            for entry in pending.values(): file.write(json.dumps({'op': 'add', 'entry': entry}) + '\n')
+        os.replace(tmp, self.journal)
+
+        for entry in pending.values(): self._push(entry)
+        if self.verbose and len(pending) > 0: print('Resuming {0} scheduled trades from {1}'.format(len(pending), self.journal))
+
+    def _push(self, entry:dict):
+        with self._cond:
+            self._pending[entry['id']] = entry
+            heapq.heappush(self._heap, (entry['when'], next(self._seq), entry['id']))
+            self._cond.notify()
+
+    def schedule(self, delay:float, side:str, tradeable, quantity:int, sell_all:bool=False, origin:dict=None):
+        """
+        Place a buy or sell of tradeable in delay seconds. sell_all sells whatever is held at that time.
+        origin describes the order this trade closes
+        """
+        entry = {'id': uuid.uuid4().hex, 'when': time.time()+delay, 'side': side, 'isin': tradeable.isin,
+                 'name': str(tradeable.name), 'quantity': quantity, 'all': sell_all, 'origin': origin}
+        self.tradeables[entry['id']] = tradeable
+        self._write({'op': 'add', 'entry': entry})
+        self._push(entry)
+        return entry
+
+    def cancel(self, entry_id:str):
+        with self._cond:
+            if self._pending.pop(entry_id, None) == None: return False
+        self.tradeables.pop(entry_id, None)
+        self._write({'op': 'done', 'id': entry_id, 'cancelled': True})
+        return True
+
+    def complete(self, entry_id:str):
+        """
+        Mark a pending trade as done after running it outside the scheduler
+        """
+        with self._cond:
+            if self._pending.pop(entry_id, None) == None: return False
+        self.tradeables.pop(entry_id, None)
+        self._write({'op': 'done', 'id': entry_id})
+        return True
+
+    def _pop_due(self, now:float=None):
+        # entries due by now, skipping heap items that were cancelled or already run
+        due = list()
+        with self._cond:
+            while len(self._heap) > 0 and (now == None or self._heap[0][0] <= now):
+                entry = self._pending.pop(heapq.heappop(self._heap)[2], None)
+                if entry != None: due.append(entry)
+        return due
+
+    def _run(self, entry:dict):
+        delay = None
+        try: delay = self.execute(entry)
+        except Exception as e: print('Error executing scheduled {0} of {1}: {2!r}'.format(entry['side'], entry['name'], e))
+        if delay != None:
+            # put off, e.g. until the market opens. The new entry replaces the old one in the journal
+            entry = dict(entry, when=time.time()+max(delay, self.min_deferral))
+            self._write({'op': 'add', 'entry': entry})
+            self._push(entry)
+            return
+        self.tradeables.pop(entry['id'], None)
+        self._write({'op': 'done', 'id': entry['id']})
+
+    def _loop(self):
+        while True:
+            with self._cond:
+                while self._running:
+                    wait = self._heap[0][0]-time.time() if len(self._heap) > 0 else None
+                    if wait != None and wait <= 0: break
+                    self._cond.wait(wait)
+                if not self._running: return
+            for entry in self._pop_due(time.time()): self._run(entry)
+
+    def start(self):
+        with self._cond: self._running = True
+        self._thread = Thread(target=self._loop, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop the scheduler thread, leaving pending trades in the journal
+        """
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        if self._thread != None: self._thread.join()
+
+    def execute_all(self):
+        """
+        Run every pending trade now, e.g. on shutdown
+        """
+        self.stop()
+        entries = self._pop_due()
+        for entry in entries: self._run(entry)
+        return len(entries)
@@ -0,0 +1,116 @@
+from threading import Thread, Lock
+from bisect import insort
+import json, time
+
+class ShutdownCoordinator:
+    """
+    Winds down trading within one deadline: drops the trades still waiting to be netted
+    that would only be closed out again right away, cancels the open orders, then runs the
+    pending close-outs (most valuable first, retrying failures) and finally compares
+    the positions we think we hold with the account's. Every step runs on up to
+    concurrency threads. Close-outs that don't finish in time stay in the scheduler's
+    journal, so the next start runs them.
+    """
+    def __init__(self, scheduler, orders, execute, value=None, intents=None, ledger=None, holdings=None,
+                 concurrency:int=8, deadline:float=20, retries:int=2, verbose:bool=False):
+        self.scheduler = scheduler
+        self.orders = orders # orders() returns the open orders, each with a delete()
+        self.execute = execute # execute(entry) places a close-out right away, raising if it fails
+        self.value = value or (lambda entry: 0) # value(entry) of the position, to order them by
+        self.intents = intents # the OrderIntents still netting trades
+        self.ledger = ledger; self.holdings = holdings # holdings(isin) is what the account really holds
+        self.concurrency = concurrency
+        self.deadline = deadline
+        self.retries = retries
+        self.verbose = verbose
+
+    def run_all(self, fn, items:list, until:float, attempts:int=1):
+        """
+        fn(item) for every item, earlier items first, on daemon threads so a hung call can't hold up exit.
+        A failed item is tried again (ahead of the items after it) up to attempts times.
+        Returns {index: (ok, result or last error)} for the items that finished by until
+        """
+        work, results, tries, lock = [(i, item) for i, item in enumerate(items)], dict(), dict(), Lock()
+        def worker():
+            while time.time() < until:
+                with lock:
+                    if len(work) <= 0: return
+                    i, item = work.pop(0)
+                    tries[i] = tries.get(i, 0) + 1
+                try: result = (True, fn(item))
+                except Exception as e: result = (False, e)
+                with lock:
+                    results[i] = result
+                    if not result[0] and tries[i] < attempts: insort(work, (i, item), key=lambda pair: pair[0])
+        threads = [Thread(target=worker, daemon=True) for _ in range(min(self.concurrency, len(items)))]
+        for thread in threads: thread.start()
+        for thread in threads: thread.join(max(until-time.time(), 0))
+        with lock: return dict(results)
+
+    def cancel_orders(self, until:float):
+        # fetching the orders is a request of its own, so it is held to the same deadline
+        fetched = self.run_all(lambda _: list(self.orders()), [None], until, attempts=self.retries+1)
+        if not fetched.get(0, (False, ))[0]:
+            error = fetched[0][1] if 0 in fetched else 'timed out'
+            return {'open': None, 'cancelled': 0, 'failed': ['Could not fetch open orders: {0!r}'.format(error)], 'unfinished': None}
+        orders = fetched[0][1]
+        results = self.run_all(lambda order: order.delete(), orders, until)
+        failed = [repr(result) for ok, result in results.values() if not ok]
+        return {'open': len(orders), 'cancelled': len(results)-len(failed), 'failed': failed, 'unfinished': len(orders)-len(results)}
+
+    def close_out(self, until:float):
+        entries = self.scheduler.pending()
+        values = self.run_all(self.value, entries, until)
+        values = {entry['id']: values[i][1] if values.get(i, (False, ))[0] else 0 for i, entry in enumerate(entries)}
+        entries.sort(key=lambda entry: -values[entry['id']])
+
+        def run(entry):
+            self.execute(entry)
+            self.scheduler.complete(entry['id'])
+        results = self.run_all(run, entries, until, attempts=self.retries+1)
+
+        left = [{'name': entry['name'], 'isin': entry['isin'], 'side': entry['side'], 'value': values[entry['id']],
+                 'error': repr(results[i][1]) if i in results else None} for i, entry in enumerate(entries) if not results.get(i, (False, ))[0]]
+        return {'executed': len(entries)-len(left), 'left': left}
+
+    def reconcile(self, until:float):
+        if self.ledger == None or self.holdings == None: return dict()
+        intended = self.ledger.positions()
+        isins = list(intended.keys())
+        actual = self.run_all(self.holdings, isins, until)
+        drift = dict()
+        for i, isin in enumerate(isins):
+            held = int(actual[i][1]) if actual.get(i, (False, ))[0] else None
+            if held != intended[isin]: drift[isin] = {'intended': intended[isin], 'actual': held}
+        return drift
+
+    def run(self, report_path:str=None):
+        started = time.time()
+        until = started + self.deadline
+        self.scheduler.stop()
+
+        # opening trades still in the netting window would be closed out straight away, so they
+        # are dropped before anything is cancelled. Close-outs among them are placed afterwards
+        report = {'intents-dropped': 0}
+        if self.intents != None:
+            self.intents.stop(flush=False, timeout=self.deadline/6) # an order still being submitted
+            report['intents-dropped'] = self.intents.drop_opening()
+
+        # a hung call only holds up its own step: cancelling gets the first third of the
+        # deadline, close-outs run until the last sixth, which is left for reconciling
+        report['orders'] = self.cancel_orders(started + self.deadline/3)
+        if self.intents != None: self.intents.flush()
+        report['close-outs'] = self.close_out(until - self.deadline/6)
+        report['drift'] = self.reconcile(until)
+        report['seconds'] = time.time()-started
+        report['deadline-reached'] = time.time() >= until
+
+        left = report['close-outs']['left']
+        print('Shutdown: dropped {0} waiting trades, cancelled {1}/{2} orders, executed {3} close-outs, {4} left for the next start, {5} positions differ ({6:.1f}s)'.format(
+            report['intents-dropped'], report['orders']['cancelled'], report['orders']['open'] if report['orders']['open'] != None else '?', report['close-outs']['executed'], len(left), len(report['drift']), report['seconds']))
+        if len(left) > 0 or len(report['drift']) > 0 or self.verbose: print(json.dumps({'left': left, 'drift': report['drift']}, indent=2))
+        if report_path:
+            try:
+                with open(report_path, 'w') as file: json.dump(report, file, indent=2)
+            except OSError as e: print('Could not write shutdown report: {0!r}'.format(e))
+        return report
@@ -1,11 +1,27 @@
-import json, os
+import json, os, re
 import tweepy
-from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from threading import Thread, Condition
 from inspect import signature
-import sys, traceback, requests
+import sys, traceback, requests, time
+from metrics import metrics
+from archive import archive
+
+# use a faster JSON decoder if one is installed
+try: from orjson import loads as json_loads
+except ImportError:
+    try: from ujson import loads as json_loads
+    except ImportError: from json import loads as json_loads
 from unicodedata import normalize
 
+# keep-alive connections for the symbol lookups
+session = requests.Session()
+session.mount('http://', requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=16))
+session.mount('https://', requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=16))
+
 class Twitter:
+    cashtag_cache = None # set to a LookupCache to remember symbol lookups
+
     def __init__(self, consumer_key, consumer_secret, app_token, app_secret):
         assert consumer_key, 'No consumer key'
         assert consumer_secret, 'No consumer secret'
@@ -21,13 +37,26 @@ class Twitter:
         try: return self.stream_listener
         except AttributeError: return False
     
-    def open_stream(self, is_async:bool=True, users=['25073877'], restrict=True, verbose=True):
+    def open_stream(self, is_async:bool=True, users=['25073877'], restrict=True, verbose=True, ingest:dict=dict()):
         if not self.stream_open():
-            self.stream_listener = CallbackStreamListener(self.callback, swallow_errors=not verbose, filter_users=(users if restrict else list()))
+            self.stream_listener = CallbackStreamListener(self.callback, swallow_errors=not verbose, filter_users=(users if restrict else list()), **ingest)
             self.stream = tweepy.Stream(auth=self.api.auth, listener=self.stream_listener)
             self.stream.on_closed(lambda: self.close_stream())
             self.stream.filter(follow=users, is_async=is_async)
 
+    def update_follows(self, users):
+        """
+        Filter the open stream on a new list of users, returning the ones that were added.
+        Tweets from dropped users stop right away, but the stream only starts sending
+        tweets from added ones once it is reopened with them.
+        """
+        users = [str(user) for user in users]
+        if not self.stream_open(): return users
+        listener = self.stream_listener
+        added = [user for user in users if user not in listener.filter]
+        if len(listener.filter) > 0: listener.filter = frozenset(user.lower() for user in users) # swapped, never changed in place
+        return added
+
     def callback(self, tweet_json):
         pass
 
@@ -78,11 +107,16 @@ class Twitter:
     
     @staticmethod
     def cashtag_to_stock(symbol:str):
+        if Twitter.cashtag_cache == None: return Twitter._cashtag_to_stock(symbol)
+        return Twitter.cashtag_cache.get_or_load(str(symbol).upper(), lambda: Twitter._cashtag_to_stock(symbol))
+
+    @staticmethod
+    def _cashtag_to_stock(symbol:str):
         # necessary because German symbols are significantly different from NYSE symbols
         # https://stackoverflow.com/questions/38967533/retrieve-company-name-with-ticker-symbol-input-yahoo-or-google-api
         url = "http://d.yimg.com/autoc.finance.yahoo.com/autoc?query={}&region=1&lang=en".format(symbol)
 
-        result = requests.get(url).json()
+        result = session.get(url).json()
 
         for x in result['ResultSet']['Result']:
             if x['symbol'] == symbol:
@@ -98,15 +132,25 @@ class Twitter:
             return keys['consumer-key'], keys['consumer-secret'], keys['app-token'], keys['app-secret']
 
 class CallbackStreamListener(tweepy.StreamListener):
-    def __init__(self, callback, swallow_errors:bool=False, num_threads:int=5, filter_users:list=[]):
+    def __init__(self, callback, swallow_errors:bool=False, num_threads:int=5, filter_users:list=[],
+                 max_queue:int=256, overflow:str='drop-oldest', max_age:float=None, priorities:dict=dict()):
         assert callable(callback) and len(signature(callback).parameters) == 1, 'Callback must be a callable that supports 1 arguement'
-        self.executor = ThreadPoolExecutorStackTraced(num_threads) if not swallow_errors else ThreadPoolExecutor(num_threads)
+        self.queue = IngestQueue(lambda data, enqueued: self.handle_data(data, enqueued), num_threads=num_threads, max_size=max_queue, overflow=overflow, max_age=max_age, swallow_errors=swallow_errors)
         self.callback = callback
-        self.filter = filter_users
+        self.filter = frozenset(str(user).lower() for user in filter_users)
+        self.priorities = {str(user): priority for user, priority in priorities.items()} # user id -> lane, lower runs first
         super().__init__()
 
     def on_data(self, data):
-        self.executor.submit(self.handle_data, data)
+        # drop deletes, limit notices and tweets from users we don't follow before they are queued or decoded
+        if peek_type(data) in non_tweet_types:
+            metrics.count('prefiltered')
+            return
+        user = peek_user(data)
+        if user != None and len(self.filter) > 0 and user not in self.filter:
+            metrics.count('prefiltered')
+            return
+        self.queue.put(data, priority=self.priorities.get(user, IngestQueue.default_priority), sent=peek_timestamp(data))
 
     def on_error(self, status_code):
         if status_code == 420: # If we disconnect from the stream, kill ourselves
@@ -115,37 +159,136 @@ class CallbackStreamListener(tweepy.StreamListener):
         if status_code == 401:
             raise ValueError('Authorization invalid! Check your keys!')
     
-    def handle_data(self, data):
+    def handle_data(self, data, enqueued:float=None):
+        metrics.begin(enqueued)
+        archive.begin(data)
+        handled = False
         try:
-            tweet = json.loads(data)
-            tweet['text'] # simply call to check for malformed tweet
-        except (KeyError, ValueError): return
+            with metrics.stage('parse'):
+                try:
+                    tweet = json_loads(data)
+                    tweet['text'] # simply call to check for malformed tweet
+                except (KeyError, ValueError): return
 
-        try: user = tweet['user']['id_str'].lower()
-        except KeyError: return
-        
-        if len(self.filter) <= 0 or user in self.filter:
-            self.callback(tweet)
+                try: user = tweet['user']['id_str'].lower()
+                except KeyError: return
+            
+            if len(self.filter) <= 0 or user in self.filter:
+                handled = True
+                self.callback(tweet)
+        finally:
+            if not handled: archive.note('ignored', True)
+            archive.end()
+            metrics.end('tweet' if handled else 'ignored')
 
     def close(self):
-        self.executor.shutdown(wait=True)
-
-# Adapted from https://stackoverflow.com/questions/19309514/getting-original-line-number-for-exception-in-concurrent-futures/24457608#24457608
-class ThreadPoolExecutorStackTraced(ThreadPoolExecutor):
-    def submit(self, fn, *args, **kwargs):
-        """Submits the wrapped function instead of `fn`"""
-        return super(ThreadPoolExecutorStackTraced, self).submit(
-            self._function_wrapper, fn, *args, **kwargs)
-
-    def _function_wrapper(self, fn, *args, **kwargs):
-        """Wraps `fn` in order to preserve the traceback of any kind of
-        raised exception
-        """
-        try:
-            return fn(*args, **kwargs)
-        except Exception:
-            traceback.print_exc()
+        self.queue.close()
+
+# cheap looks into a raw payload, before it is decoded
+non_tweet_types = frozenset(('delete', 'limit', 'scrub_geo', 'status_withheld', 'user_withheld', 'disconnect', 'warning', 'friends', 'event'))
+_type_re = re.compile(r'\s*\{\s*"(\w+)"')
+_user_re = re.compile(r'"user":\s*\{\s*"id":\s*\d+,\s*"id_str":\s*"(\d+)"')
+_timestamp_re = re.compile(r'"timestamp_ms":\s*"(\d+)"')
+
+def peek_type(data):
+    # the first key of a message tells notices apart from tweets
+    match = _type_re.match(data)
+    return match.group(1) if match else None
 
+def peek_user(data):
+    # the first user object in a tweet is its author's, retweeted users come later
+    match = _user_re.search(data)
+    return match.group(1) if match else None
+
+def peek_timestamp(data):
+    match = _timestamp_re.search(data)
+    return int(match.group(1))/1000 if match else None
+
+class IngestQueue:
+    """
+    Bounded, prioritised queue of raw payloads, worked off by num_threads threads.
+    When full, overflow decides what gives: 'drop-oldest' drops the oldest payload,
+    'drop-priority' drops the oldest payload of the lowest priority lane, 'block' waits.
+    Payloads older than max_age seconds (since sent, or since queued) are dropped unhandled.
+    """
+    default_priority = 1
+    policies = ('drop-oldest', 'drop-priority', 'block')
+
+    def __init__(self, handle, num_threads:int=5, max_size:int=256, overflow:str='drop-oldest', max_age:float=None, swallow_errors:bool=False):
+        assert overflow in IngestQueue.policies, 'Overflow must be one of {0}'.format(IngestQueue.policies)
+        self.handle = handle # handle(data, enqueued)
+        self.max_size = max_size; self.overflow = overflow; self.max_age = max_age
+        self.swallow_errors = swallow_errors
+        self.lanes = dict() # priority -> deque of (enqueued, sent, data)
+        self.size = 0
+        self.dropped = {'overflow': 0, 'stale': 0}
+        self.handled = 0
+        self._cond = Condition()
+        self._open = True
+        self._threads = [Thread(target=self._work, daemon=True) for _ in range(num_threads)]
+        for thread in self._threads: thread.start()
+
+    def put(self, data, priority:int=default_priority, sent:float=None):
+        with self._cond:
+            if not self._open: return False
+            while self.size >= self.max_size:
+                if self.overflow == 'block': self._cond.wait()
+                elif self.overflow == 'drop-priority' and priority > max(p for p, lane in self.lanes.items() if lane):
+                    self._drop('overflow')
+                    return False
+                else: self._evict()
+            self.lanes.setdefault(priority, deque()).append((time.perf_counter(), sent, data))
+            self.size += 1
+            metrics.gauge('queue-depth', self.size)
+            self._cond.notify_all()
+            return True
+
+    def _evict(self):
+        if self.overflow == 'drop-priority': lane = self.lanes[max(p for p, lane in self.lanes.items() if lane)]
+        else: lane = min((lane for lane in self.lanes.values() if lane), key=lambda lane: lane[0][0])
+        lane.popleft()
+        self.size -= 1
+        self._drop('overflow')
+
+    def _drop(self, reason:str):
+        self.dropped[reason] += 1
+        metrics.count('dropped-' + reason)
+
+    def _get(self):
+        with self._cond:
+            while True:
+                while self.size <= 0:
+                    if not self._open: return None
+                    self._cond.wait()
+                enqueued, sent, data = self.lanes[min(p for p, lane in self.lanes.items() if lane)].popleft()
+                self.size -= 1
+                self._cond.notify_all()
+                if self.max_age != None and (time.perf_counter()-enqueued > self.max_age or (sent != None and time.time()-sent > self.max_age)):
+                    self._drop('stale')
+                    continue
+                return enqueued, data
+
+    def _work(self):
+        while True:
+            item = self._get()
+            if item == None: return
+            try: self.handle(item[1], item[0])
+            except Exception:
+                if not self.swallow_errors: traceback.print_exc()
+            with self._cond: self.handled += 1
+
+    def stats(self):
+        with self._cond:
+            return {'depth': self.size, 'lanes': {p: len(lane) for p, lane in self.lanes.items()}, 'dropped': dict(self.dropped), 'handled': self.handled}
+
+    def close(self):
+        """
+        Stop taking payloads and wait for the queued ones to be handled
+        """
+        with self._cond:
+            self._open = False
+            self._cond.notify_all()
+        for thread in self._threads: thread.join()
 
 if __name__ == "__main__":
     twtr = Twitter(*Twitter.load_from_file(path='keys-actual.json'))
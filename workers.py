@@ -0,0 +1,79 @@
+import multiprocessing, time, traceback
+from threading import Thread
+
+class AnalysisWorkers:
+    """
+    Analyses tweets in worker processes, each searching the same memory-mapped
+    tradeable index (see catalog.write_index). Only (isin, similarity) pairs come back,
+    so the process that owns the account is the only one placing orders.
+    """
+    def __init__(self, index_path:str, on_result, processes:int=2, options:dict=dict(), max_queue:int=256):
+        self.on_result = on_result # on_result(text, sentiment, [(isin, similarity)], cashtags, tweet id), called from one thread
+        context = multiprocessing.get_context('spawn') # lemon, nltk and tweepy don't survive a fork well
+        self.tweets = context.Queue(maxsize=max_queue)
+        self.results = context.Queue()
+        self.processes = [context.Process(target=_worker, args=(index_path, options, self.tweets, self.results), daemon=True) for _ in range(processes)]
+        for process in self.processes: process.start()
+        self._collector = Thread(target=self._collect, daemon=True)
+        self._collector.start()
+
+    def submit(self, tweet):
+        self.tweets.put(tweet)
+
+    def _collect(self):
+        running = len(self.processes)
+        while running > 0:
+            result = self.results.get()
+            if result == None:
+                running -= 1
+                continue
+            try: self.on_result(*result)
+            except Exception: traceback.print_exc()
+
+    def close(self, timeout:float=10):
+        for _ in self.processes: self.tweets.put(None)
+        for process in self.processes: process.join(timeout)
+        self._collector.join(timeout)
+
+def _worker(index_path:str, options:dict, tweets, results):
+    # imported here so the parent doesn't pay for them twice
+    import nlp_analysis
+    from nlp_analysis import TextToTradeables
+    from twitter import Twitter
+    from catalog import MappedIndex
+
+    nlp_analysis.allow_downloads = options.get('allow-downloads', True)
+    try: nlp_analysis.prewarm(cache_path=options.get('nlp-cache'))
+    except Exception: traceback.print_exc() # the components are built on first use instead
+    try:
+        index = MappedIndex(index_path)
+        checked = time.time()
+
+        while True:
+            tweet = tweets.get()
+            if tweet == None: break
+            # pick up the index the parent rewrote after a catalog refresh
+            if time.time()-checked > options.get('reopen-interval', 60):
+                try: index.reopen_if_changed()
+                except Exception as e: print('Could not reopen tradeable index: {0!r}'.format(e))
+                checked = time.time()
+            try: results.put(analyse(tweet, index, options, TextToTradeables, Twitter))
+            except Exception: traceback.print_exc()
+    finally: results.put(None) # or the collector and close() wait for this worker forever
+
+def analyse(tweet, index, options:dict, TextToTradeables, Twitter):
+    # the same analysis as main.analyse_tweet, against the mapped index instead of lemon
+    from catalog import suffix_search
+    txt = Twitter.get_tweet_text(tweet)
+    sent = TextToTradeables.get_sentiment(txt)
+    if sent == 0: return txt, sent, list(), list(), tweet.get('id_str') # nothing would be traded, don't bother searching
+
+    stocks = list()
+    for phrase in TextToTradeables.get_noun_phrases(txt):
+        if len(str(phrase).replace(' ', '')) < 4: continue
+        tradeable, similarity = suffix_search(index.search, str(phrase), 'stock')
+        if tradeable == None or similarity >= options['match'] or similarity*len(tradeable.name) > options['weighted']: continue
+        stocks.append((tradeable, similarity))
+
+    # cashtags go back as symbols, for the main process to look up with lemon's search and its caches
+    return txt, sent, [(tradeable.isin, similarity) for tradeable, similarity in stocks], Twitter.get_tweet_cashtags(tweet), tweet.get('id_str')